@@ -0,0 +1,167 @@
+from itertools import chain, groupby
+from operator import attrgetter
+
+
+class Bucket(object):
+    """ The candidates with the same priority, in their original order.
+
+    Removed candidates are only marked, the remaining candidates are counted
+    by a Fenwick tree, so indexing and removal take logarithmic time.
+
+    """
+
+    __slots__ = ('priority', 'bookings', 'alive', 'size', 'tree', 'step')
+
+    def __init__(self, priority, bookings):
+        self.priority = priority
+        self.bookings = bookings
+        self.alive = [True] * len(bookings)
+        self.size = len(bookings)
+
+        # the tree of a sequence of ones, built in linear time
+        self.tree = tree = [0] + [1] * self.size
+
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+
+            if parent <= self.size:
+                tree[parent] += tree[i]
+
+        self.step = self.size and 1 << (self.size.bit_length() - 1)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (b for b, alive in zip(self.bookings, self.alive) if alive)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+
+        # find the position preceded by exactly index remaining candidates
+        tree, last = self.tree, len(self.bookings)
+        position, remaining, step = 0, index + 1, self.step
+
+        while step:
+            if position + step <= last and tree[position + step] < remaining:
+                position += step
+                remaining -= tree[position]
+
+            step >>= 1
+
+        return self.bookings[position]
+
+    def remove(self, ix):
+        self.alive[ix] = False
+        self.size -= 1
+
+        tree = self.tree
+        i = ix + 1
+
+        while i < len(tree):
+            tree[i] -= 1
+            i += i & -i
+
+
+class Selection(object):
+    """ A sequence of the remaining candidates of the given buckets, which
+    may be passed to :meth:`random.Random.choice`.
+
+    """
+
+    __slots__ = ('buckets', )
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def __bool__(self):
+        return any(len(bucket) for bucket in self.buckets)
+
+    def __iter__(self):
+        return chain.from_iterable(self.buckets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+
+        for bucket in self.buckets:
+            if index < len(bucket):
+                return bucket[index]
+
+            index -= len(bucket)
+
+        raise IndexError(index)
+
+
+class CandidatePool(Selection):
+    """ Holds the candidates of an occasion during greedy matching, in the
+    given order (by priority and id), grouped into buckets of the same
+    priority.
+
+    The pool is the interface between the matching loop and the pick
+    functions. A pick function is called with the pool, the open bookings
+    and the :class:`conflicts.ImpactIndex` and returns one of the
+    candidates, which is then removed by the matching loop. To stay fast,
+    pick functions should only use the following operations:
+
+    * ``len(pool)``, ``booking in pool``
+    * ``pool[index]`` (the candidates in order, negative indexes allowed)
+    * ``pool.favorites()`` and ``pool.others()`` (the candidates with and
+      without priority, with the same operations)
+
+    Indexing takes logarithmic time, the rest constant time. Iterating the
+    pool takes linear time and should be done at most once per occasion.
+
+    Picking the n-th remaining candidate at random consumes the random
+    number generator like picking from a list, so seeded runs stay the
+    same as with the array engine.
+
+    """
+
+    __slots__ = ('positions', )
+
+    def __init__(self, bookings):
+        super().__init__([
+            Bucket(priority, list(group))
+            for priority, group in groupby(
+                bookings, key=attrgetter('priority'))
+        ])
+
+        self.positions = {
+            booking: (bucket, ix)
+            for bucket in self.buckets
+            for ix, booking in enumerate(bucket.bookings)
+        }
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __bool__(self):
+        return bool(self.positions)
+
+    def __contains__(self, booking):
+        return booking in self.positions
+
+    def favorites(self):
+        return Selection([b for b in self.buckets if b.priority])
+
+    def others(self):
+        return Selection([b for b in self.buckets if not b.priority])
+
+    def remove(self, booking):
+        bucket, ix = self.positions.pop(booking)
+        bucket.remove(ix)
+
+    def discard(self, bookings):
+        """ Removes the given bookings, if they are candidates. """
+
+        for booking in bookings:
+            if booking in self.positions:
+                self.remove(booking)
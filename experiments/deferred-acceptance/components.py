@@ -0,0 +1,128 @@
+""" Matches the connected components of a period in parallel.
+
+Attendees only compete with each other through the occasions they have
+both booked and conflicts only arise between the bookings of a single
+attendee. Periods often fall apart into independent clusters (age groups,
+regions), which may be matched separately::
+
+    period = experiment.load_arrays()
+    solve_components(period, 'deferred_acceptance', seed=0)
+
+The random order in which a single :class:`engine.ArrayEngine` would queue
+the attendees (deferred acceptance) or fill the occasions (greedy matching)
+is drawn once from the seed and each component follows its slice of it.
+The components therefore yield the same states as a single run on the
+whole period with the same seed, with two exceptions:
+
+* The random pick functions of greedy matching draw their picks from a
+  generator per component, seeded with the seed and the component.
+* A single run of deferred acceptance stops once all occasions are full,
+  even if attendees are still queued. Components stop once their own
+  occasions are full, so they may let queued attendees displace others
+  where the single run would have stopped.
+
+In any case, the result does not depend on the number of processes, a
+single process yields the same states as a pool of processes.
+
+"""
+
+import numpy as np
+import os
+import random
+import zlib
+
+from engine import ArrayEngine, OPEN
+from multiprocessing import Pool
+
+
+def component_seed(seed, period):
+    """ Returns the seed of the given component, derived from its first
+    occasion, so it does not change if other components are added.
+
+    """
+    return zlib.crc32('{}:{}'.format(seed, period.occasion_ids[0]).encode())
+
+
+def shuffled_order(period, strategy, seed, matching_round=0, **options):
+    """ Returns the order in which a single run of the given strategy on
+    the whole period would queue the attendees (deferred acceptance) or
+    fill the occasions (greedy matching), as indexes of the period.
+
+    """
+    rng = random.Random(seed)
+
+    if strategy == 'deferred_acceptance':
+        # all attendees of a period have bookings
+        order = list(range(period.attendee_count))
+    else:
+        # the first round starts with all bookings open
+        open = period.state == OPEN if matching_round else slice(None)
+        order = np.unique(period.occasion[open]).tolist()
+
+    rng.shuffle(order)
+
+    return order
+
+
+def solve(task):
+    """ Matches a single component and returns its states. """
+
+    period, strategy, seed, shuffled, options = task
+
+    getattr(ArrayEngine(period), strategy)(
+        seed=component_seed(seed, period), shuffled=shuffled, **options)
+
+    return period.state
+
+
+def solve_components(period, strategy, seed=0, processes=None, **options):
+    """ Runs the given strategy of the :class:`engine.ArrayEngine` on each
+    component of the period and merges the resulting states into the
+    period. Returns the number of components.
+
+    :processes:
+        The number of worker processes (defaults to the number of cpus).
+        With a single process, the components are matched in this process.
+
+    """
+    components = period.components()
+
+    # pick functions of the experiment are passed by name
+    if callable(options.get('pick_function')):
+        options['pick_function'] = options['pick_function'].__name__
+
+    # the position of each attendee or occasion in the order of a single run
+    order = shuffled_order(period, strategy, seed, **options)
+    keys = period.attendee if strategy == 'deferred_acceptance' \
+        else period.occasion
+
+    position = np.full(keys.max() + 1 if len(keys) else 0, len(order))
+    position[order] = np.arange(len(order))
+
+    def local_order(bookings):
+        # the component indexes its keys in ascending order
+        members = np.unique(keys[bookings])
+        return np.argsort(position[members], kind='stable').tolist()
+
+    tasks = (
+        (period.select(bookings), strategy, seed, local_order(bookings),
+         options)
+        for bookings in components
+    )
+
+    def merge(states):
+        for bookings, state in zip(components, states):
+            period.state[bookings] = state
+
+    processes = processes or os.cpu_count()
+
+    if processes == 1 or len(components) < 2:
+        merge(map(solve, tasks))
+    else:
+        # many small components are sent in chunks to save round trips
+        chunksize = max(1, len(components) // (processes * 4))
+
+        with Pool(processes) as pool:
+            merge(pool.imap(solve, tasks, chunksize))
+
+    return len(components)
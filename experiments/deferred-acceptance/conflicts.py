@@ -0,0 +1,173 @@
+from collections import defaultdict
+from heapq import heapify, heappop, heappush
+from operator import itemgetter
+
+
+class OccasionConflicts(object):
+    """ Holds the overlaps between all occasions of a period.
+
+    Whether two occasions overlap only depends on the occasions themselves,
+    so we compute this once per period instead of comparing dates in the
+    matching loops.
+
+    The occasions are sorted by start and compared in a single sweep. The
+    result is stored in a bitset (one bit per pair of occasions) for
+    constant-time lookups, as well as in an adjacency list to enumerate the
+    conflicts of a single occasion.
+
+    Overlaps are defined as in :func:`sedate.overlaps` - the dates are
+    inclusive and each occasion overlaps with itself.
+
+    """
+
+    def __init__(self, occasions):
+        """ Takes an iterable of (key, start, end) tuples. """
+
+        occasions = sorted(occasions, key=itemgetter(1, 2))
+
+        #: the keys in the order of their start date
+        self.keys = [key for key, start, end in occasions]
+
+        #: the position of each key in the order of their start date
+        self.index = {key: ix for ix, key in enumerate(self.keys)}
+
+        self.size = len(self.keys)
+        self.bits = bytearray((self.size * self.size + 7) // 8)
+        self.adjacent = [[] for _ in range(self.size)]
+
+        # the occasions which have started, but not necessarily ended
+        active = []
+
+        for ix, (key, start, end) in enumerate(occasions):
+
+            while active and active[0][0] < start:
+                heappop(active)
+
+            self.set(ix, ix)
+
+            for _, other in active:
+                self.set(ix, other)
+                self.set(other, ix)
+                self.adjacent[ix].append(other)
+                self.adjacent[other].append(ix)
+
+            heappush(active, (end, ix))
+
+    def __len__(self):
+        return self.size
+
+    def set(self, a, b):
+        bit = a * self.size + b
+        self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def get(self, a, b):
+        bit = a * self.size + b
+        return self.bits[bit >> 3] >> (bit & 7) & 1 == 1
+
+    def overlaps(self, a, b):
+        """ Returns True if the given occasions overlap. """
+        return self.get(self.index[a], self.index[b])
+
+    def conflicting(self, key):
+        """ Returns the keys of all occasions overlapping the given one
+        (without the given occasion itself).
+
+        """
+        return [self.keys[ix] for ix in self.adjacent[self.index[key]]]
+
+
+class ImpactIndex(object):
+    """ Keeps track of the open bookings of each attendee and their impact.
+
+    The impact of a booking is the number of open bookings of the same
+    attendee which overlap with it (including the booking itself). That is
+    the number of bookings that would be blocked if the booking was accepted.
+
+    The index is built once and updated in place whenever bookings stop
+    being open. Since a change only affects the bookings of a single
+    attendee, this is a lot cheaper than counting the impact anew.
+
+    """
+
+    def __init__(self, bookings, conflicts):
+        self.conflicts = conflicts
+        self.by_attendee = defaultdict(list)
+        self.counts = {}
+
+        # the candidates of the current occasion, ordered by least impact
+        self.ranked = None
+        self.heap = None
+        self.positions = None
+
+        for booking in bookings:
+            self.by_attendee[booking.attendee_id].append(booking)
+
+        for group in self.by_attendee.values():
+            for booking in group:
+                self.counts[booking] = sum(
+                    1 for b in group if conflicts.overlaps(
+                        booking.occasion_id, b.occasion_id))
+
+    def impact(self, booking):
+        return self.counts[booking]
+
+    def attendee_bookings(self, attendee_id):
+        """ Returns the open bookings of the given attendee. """
+        return self.by_attendee.get(attendee_id, ())
+
+    def discard(self, bookings):
+        """ Removes the given bookings from the index, updating the impact of
+        the affected bookings.
+
+        """
+        for booking in bookings:
+            if self.counts.pop(booking, None) is None:
+                continue
+
+            group = self.by_attendee[booking.attendee_id]
+            group.remove(booking)
+
+            for b in group:
+                if self.conflicts.overlaps(booking.occasion_id, b.occasion_id):
+                    self.counts[b] -= 1
+                    self.rerank(b)
+
+    def key(self, booking):
+        # favorites first, then the ones with the least impact
+        return (not booking.priority, self.counts.get(booking, 0))
+
+    def rank(self, candidates):
+        self.ranked = candidates
+        self.positions = {b: ix for ix, b in enumerate(candidates)}
+        self.heap = [
+            (self.key(b), ix, b) for b, ix in self.positions.items()
+        ]
+        heapify(self.heap)
+
+    def rerank(self, booking):
+        # changed keys are pushed again, the outdated entries are skipped
+        if self.ranked is not None and booking in self.positions:
+            heappush(self.heap, (
+                self.key(booking), self.positions[booking], booking))
+
+    def least(self, candidates):
+        """ Returns the favorite with the least impact amongst the given
+        candidates. If there are no favorites, the non-favorite with the least
+        impact is returned. Ties are resolved by the order of the candidates.
+
+        The candidates are ranked once, subsequent calls with the same
+        candidates take logarithmic time.
+
+        """
+        if self.ranked is not candidates:
+            self.rank(candidates)
+
+        while self.heap:
+            key, ix, booking = self.heap[0]
+
+            if booking in candidates and key == self.key(booking):
+                return booking
+
+            heappop(self.heap)
+
+        raise ValueError("No candidates left")
@@ -0,0 +1,1073 @@
+""" A matching engine working on typed arrays instead of ORM objects.
+
+The period is loaded once into numpy arrays (one entry per booking/occasion)
+and the matching strategies of the experiment are run on those arrays. The
+resulting states are written back to the database in one step.
+
+The strategies consume the random number generator exactly like their
+ORM-based counterparts, so for a fixed seed they produce the same result.
+
+Periods may be stored as snapshots and loaded again later, so strategies and
+metrics may be run without a database::
+
+    experiment.export_snapshot('period')
+
+    period = ArrayPeriod.load('period')
+    ArrayEngine(period).deferred_acceptance(seed=0)
+
+    print(period.global_happiness, period.operable_courses)
+
+"""
+
+import itertools
+import numpy as np
+import os
+import random
+import uuid
+
+from bisect import bisect_left, insort
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from heapq import heapify, heappush, heapreplace
+from itertools import chain
+
+
+#: the booking states, encoded by their index
+STATES = ('open', 'accepted', 'blocked', 'denied', 'cancelled')
+OPEN, ACCEPTED, BLOCKED = 0, 1, 2
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+#: the arrays stored in a snapshot, the rest is derived from them
+SNAPSHOT = (
+    'occasion_ids',
+    'start',
+    'end',
+    'lower',
+    'upper',
+    'booking_ids',
+    'attendee_ids',
+    'attendee',
+    'occasion',
+    'priority',
+    'state',
+)
+
+
+def timestamp(value):
+    """ Returns the given datetime as microseconds since the epoch. Integers
+    are expected to be timestamps already and are returned as is.
+
+    """
+    if isinstance(value, datetime):
+        return (value - EPOCH) // timedelta(microseconds=1)
+
+    return int(value)
+
+
+class ArrayPeriod(object):
+    """ Holds the occasions and bookings of a period in typed arrays.
+
+    Occasions are indexed in the order of their ids, bookings are ordered by
+    occasion, priority and id (the order used by the greedy matching).
+    Attendees are indexed in the order of their ids.
+
+    """
+
+    def __init__(self, occasions, bookings):
+        """ Takes an iterable of occasions as (id, start, end, lower, upper)
+        and an iterable of bookings as (id, attendee_id, occasion_id, priority,
+        state). The spots are given as half-open interval, like they are
+        stored in the database.
+
+        """
+        occasions = sorted(occasions, key=lambda o: o[0])
+
+        self.occasion_ids = [o[0] for o in occasions]
+        occasion_index = {id: ix for ix, id in enumerate(self.occasion_ids)}
+
+        self.start = np.array([timestamp(o[1]) for o in occasions], np.int64)
+        self.end = np.array([timestamp(o[2]) for o in occasions], np.int64)
+        self.lower = np.array([o[3] for o in occasions], np.int32)
+        self.upper = np.array([o[4] for o in occasions], np.int32)
+
+        bookings = sorted(
+            bookings, key=lambda b: (occasion_index[b[2]], b[3], b[0]))
+
+        self.booking_ids = [b[0] for b in bookings]
+        self.attendee_ids = sorted(set(b[1] for b in bookings))
+        attendee_index = {id: ix for ix, id in enumerate(self.attendee_ids)}
+
+        self.attendee = np.array(
+            [attendee_index[b[1]] for b in bookings], np.int32)
+        self.occasion = np.array(
+            [occasion_index[b[2]] for b in bookings], np.int32)
+        self.priority = np.array([b[3] for b in bookings], np.int32)
+        self.state = np.array(
+            [STATES.index(b[4]) for b in bookings], np.int8)
+
+        self.build()
+
+    def build(self):
+        """ Builds the indexes derived from the stored arrays. """
+
+        # the state as loaded, to find the changes later
+        self.initial_state = self.state.copy()
+
+        # the order of the booking ids
+        self.rank = np.empty(self.booking_count, np.int32)
+        self.rank[sorted(
+            range(self.booking_count), key=self.booking_ids.__getitem__)] = \
+            np.arange(self.booking_count, dtype=np.int32)
+
+        self.index_bookings()
+
+    def index_bookings(self):
+        """ Builds the indexes of the bookings by occasion and attendee. """
+
+        # the bookings are grouped by occasion already
+        self.occasion_ptr = np.zeros(self.occasion_count + 1, np.int64)
+        np.cumsum(
+            np.bincount(self.occasion, minlength=self.occasion_count),
+            out=self.occasion_ptr[1:])
+
+        # the bookings grouped by attendee
+        self.by_attendee = np.argsort(self.attendee, kind='stable')
+        self.attendee_ptr = np.zeros(self.attendee_count + 1, np.int64)
+        np.cumsum(
+            np.bincount(self.attendee, minlength=self.attendee_count),
+            out=self.attendee_ptr[1:])
+
+    def save(self, path):
+        """ Stores the period as snapshot, which may be loaded without a
+        database using :meth:`load`.
+
+        Paths ending in '.npz' result in a single compressed file. Other
+        paths result in a directory with one uncompressed file per array,
+        which may be memory-mapped when loading.
+
+        The ids are stored as strings and loaded as :class:`uuid.UUID`.
+
+        """
+        arrays = {name: getattr(self, name) for name in SNAPSHOT}
+
+        for name in ('occasion_ids', 'booking_ids', 'attendee_ids'):
+            arrays[name] = np.array([str(id) for id in arrays[name]])
+
+        if path.endswith('.npz'):
+            np.savez_compressed(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+
+            for name, array in arrays.items():
+                np.save(os.path.join(path, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Loads a snapshot stored by :meth:`save`. Snapshot directories are
+        memory-mapped, unless disabled.
+
+        The states are always copied into memory, as they are changed by
+        the matching strategies.
+
+        """
+        period = cls.__new__(cls)
+
+        if os.path.isdir(path):
+            mmap_mode = mmap and 'r' or None
+
+            for name in SNAPSHOT:
+                setattr(period, name, np.load(
+                    os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        else:
+            with np.load(path) as arrays:
+                for name in SNAPSHOT:
+                    setattr(period, name, arrays[name])
+
+        # the ids are used to write the states back to the database
+        for name in ('occasion_ids', 'booking_ids', 'attendee_ids'):
+            setattr(period, name, [
+                uuid.UUID(id) for id in getattr(period, name).tolist()])
+
+        period.state = np.array(period.state)
+        period.build()
+
+        return period
+
+    def __getstate__(self):
+        # the derived indexes are rebuilt after unpickling
+        return {name: getattr(self, name) for name in SNAPSHOT}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build()
+
+    @property
+    def booking_count(self):
+        return len(self.booking_ids)
+
+    @property
+    def occasion_count(self):
+        return len(self.occasion_ids)
+
+    @property
+    def attendee_count(self):
+        return len(self.attendee_ids)
+
+    def overlaps(self, a, b):
+        """ Returns True if the given occasions overlap, element-wise for
+        arrays. Like :func:`sedate.overlaps`, the bounds are inclusive.
+
+        The overlaps are computed from the dates instead of being stored,
+        as a matrix of all occasions would grow quadratically.
+
+        """
+        return (self.start[a] <= self.end[b]) & (self.start[b] <= self.end[a])
+
+    def occasion_bookings(self, occasion):
+        """ Returns the bookings of the given occasion (ordered). """
+        return np.arange(
+            self.occasion_ptr[occasion], self.occasion_ptr[occasion + 1])
+
+    def attendee_bookings(self, attendee):
+        """ Returns the bookings of the given attendee. """
+        return self.by_attendee[
+            self.attendee_ptr[attendee]:self.attendee_ptr[attendee + 1]]
+
+    def attendee_pairs(self):
+        """ Returns all pairs of bookings sharing the same attendee as two
+        arrays (including the pairs of a booking with itself).
+
+        """
+        order = self.by_attendee
+        group = self.attendee[order]
+        sizes = (self.attendee_ptr[1:] - self.attendee_ptr[:-1])[group]
+
+        i = np.repeat(order, sizes)
+        first = np.repeat(self.attendee_ptr[group], sizes)
+        offset = np.arange(len(i)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+        return i, order[first + offset]
+
+    def components(self):
+        """ Returns the connected components of the period, as a list of
+        arrays of bookings (ordered).
+
+        Attendees are connected through the occasions they have booked.
+        Bookings of different components never compete for the same spots
+        or block each other, so the components may be matched separately.
+
+        """
+        parent = list(range(self.occasion_count))
+
+        def find(o):
+            while parent[o] != o:
+                parent[o] = parent[parent[o]]
+                o = parent[o]
+
+            return o
+
+        # join the occasions booked by the same attendee
+        attendees = self.attendee[self.by_attendee].tolist()
+        occasions = self.occasion[self.by_attendee].tolist()
+        previous = None
+
+        for a, o in zip(attendees, occasions):
+            if a != previous:
+                root = find(o)
+                previous = a
+            else:
+                parent[find(o)] = root
+
+        roots = np.array([find(o) for o in range(self.occasion_count)])
+        component = np.unique(
+            roots[self.occasion], return_inverse=True)[1].ravel()
+
+        order = np.argsort(component, kind='stable')
+        bounds = np.cumsum(np.bincount(component))[:-1]
+
+        return np.split(order, bounds) if self.booking_count else []
+
+    def select(self, bookings):
+        """ Returns a new period with the given bookings, together with their
+        occasions and attendees. The states are copied.
+
+        """
+        bookings = np.sort(bookings)
+        occasions = np.unique(self.occasion[bookings])
+        attendees = np.unique(self.attendee[bookings])
+
+        period = self.__class__.__new__(self.__class__)
+
+        period.occasion_ids = [self.occasion_ids[o] for o in occasions]
+        period.start = self.start[occasions]
+        period.end = self.end[occasions]
+        period.lower = self.lower[occasions]
+        period.upper = self.upper[occasions]
+
+        period.booking_ids = [self.booking_ids[b] for b in bookings]
+        period.attendee_ids = [self.attendee_ids[a] for a in attendees]
+        period.attendee = np.searchsorted(
+            attendees, self.attendee[bookings]).astype(np.int32)
+        period.occasion = np.searchsorted(
+            occasions, self.occasion[bookings]).astype(np.int32)
+        period.priority = self.priority[bookings]
+        period.state = self.state[bookings]
+
+        period.build()
+
+        return period
+
+    def changes(self):
+        """ Yields the booking ids whose state changed since loading, together
+        with the name of the new state.
+
+        """
+        for ix in np.flatnonzero(self.state != self.initial_state):
+            yield self.booking_ids[ix], STATES[self.state[ix]]
+
+    def mark_written(self):
+        """ Marks the current states as written, so they are no longer part
+        of the :meth:`changes`.
+
+        """
+        self.initial_state = self.state.copy()
+
+    def occasion_index(self, occasion_id):
+        """ Returns the index of the given occasion. """
+
+        o = bisect_left(self.occasion_ids, occasion_id)
+
+        if o == self.occasion_count or self.occasion_ids[o] != occasion_id:
+            raise KeyError(occasion_id)
+
+        return o
+
+    def locate(self, booking_id, occasion_id):
+        """ Returns the index of the given booking of the given occasion, or
+        None if the booking is not part of the period. Only the bookings of
+        the occasion are searched.
+
+        """
+        for ix in self.occasion_bookings(self.occasion_index(occasion_id)):
+            if self.booking_ids[ix] == booking_id:
+                return int(ix)
+
+        return None
+
+    def update(self, bookings, removed=()):
+        """ Applies the given bookings, as (id, attendee_id, occasion_id,
+        priority, state) read from the database, and returns their indexes,
+        followed by the indexes of the removed bookings.
+
+        Bookings which are not part of the period yet are added, removed
+        bookings (given by id) are cancelled. The occasions have to be part
+        of the period already. The states are applied as loaded, so they are
+        not part of the :meth:`changes`.
+
+        Changing states takes constant time per booking (plus the search
+        through the bookings of the occasion). Adding or re-prioritising
+        bookings changes their order, which is restored in linear time.
+
+        """
+        bookings = list(bookings)
+        added = []
+        reorder = False
+
+        for id, attendee_id, occasion_id, priority, state in bookings:
+            ix = self.locate(id, occasion_id)
+
+            if ix is None:
+                added.append((id, attendee_id, occasion_id, priority, state))
+                continue
+
+            self.state[ix] = self.initial_state[ix] = STATES.index(state)
+
+            if self.priority[ix] != priority:
+                self.priority[ix] = priority
+                reorder = True
+
+        if added:
+            self.add(added)
+
+        if added or reorder:
+            self.reorder()
+
+        indexes = [self.locate(b[0], b[2]) for b in bookings]
+
+        if removed:
+            removed = set(removed)
+            cancelled = [
+                ix for ix, id in enumerate(self.booking_ids) if id in removed]
+
+            self.state[cancelled] = self.initial_state[cancelled] = \
+                STATES.index('cancelled')
+
+            indexes.extend(cancelled)
+
+        return indexes
+
+    def add(self, bookings):
+        """ Appends the given bookings (see :meth:`update`), new attendees
+        are inserted in the order of their ids. The order of the bookings
+        has to be restored with :meth:`reorder` afterwards.
+
+        """
+        self.booking_ids = list(self.booking_ids)
+        self.attendee_ids = list(self.attendee_ids)
+
+        # the bookings in the order of their ids
+        by_id = np.argsort(self.rank)
+
+        for id, attendee_id, occasion_id, priority, state in bookings:
+            a = bisect_left(self.attendee_ids, attendee_id)
+
+            if a == self.attendee_count or self.attendee_ids[a] != attendee_id:
+                self.attendee_ids.insert(a, attendee_id)
+                self.attendee[self.attendee >= a] += 1
+
+            lo, hi = 0, len(by_id)
+
+            while lo < hi:
+                mid = (lo + hi) // 2
+
+                if self.booking_ids[by_id[mid]] < id:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            self.rank[self.rank >= lo] += 1
+            by_id = np.insert(by_id, lo, self.booking_count)
+
+            self.booking_ids.append(id)
+            self.attendee = np.append(self.attendee, np.int32(a))
+            self.occasion = np.append(
+                self.occasion, np.int32(self.occasion_index(occasion_id)))
+            self.priority = np.append(self.priority, np.int32(priority))
+            self.rank = np.append(self.rank, np.int32(lo))
+
+            state = np.int8(STATES.index(state))
+            self.state = np.append(self.state, state)
+            self.initial_state = np.append(self.initial_state, state)
+
+    def reorder(self):
+        """ Restores the order of the bookings by occasion, priority and id
+        and rebuilds the indexes of the bookings.
+
+        """
+        order = np.lexsort((self.rank, self.priority, self.occasion))
+
+        self.booking_ids = [self.booking_ids[ix] for ix in order.tolist()]
+
+        for name in ('attendee', 'occasion', 'priority', 'state',
+                     'initial_state', 'rank'):
+            setattr(self, name, getattr(self, name)[order])
+
+        self.index_bookings()
+
+    def happiness_scores(self):
+        """ Returns the happiness of all attendees with bookings, like
+        :meth:`experiment.Experiment.happiness_scores`.
+
+        """
+        weight = self.priority + 1.0
+
+        accepted = np.bincount(
+            self.attendee,
+            weights=weight * (self.state == ACCEPTED),
+            minlength=self.attendee_count)
+
+        total = np.bincount(
+            self.attendee, weights=weight, minlength=self.attendee_count)
+
+        return accepted / total
+
+    @property
+    def global_happiness(self):
+        return float(np.mean(self.happiness_scores()))
+
+    @property
+    def global_happiness_stdev(self):
+        return float(np.std(self.happiness_scores(), ddof=1))
+
+    def accepted_counts(self):
+        """ Returns the number of accepted bookings of each occasion. """
+        return np.bincount(
+            self.occasion[self.state == ACCEPTED],
+            minlength=self.occasion_count)
+
+    @property
+    def operable_courses(self):
+        if not self.occasion_count:
+            return 0
+
+        return float(np.mean(self.accepted_counts() >= self.lower))
+
+    def blocking_pairs(self, score=None):
+        """ Returns the bookings (ordered) which are not accepted, though
+        both their attendee and their occasion would prefer them:
+
+        * The attendee prefers the booking to all accepted bookings it
+          overlaps with (by priority, then id), or has no such bookings.
+        * The occasion has free spots, or accepted a booking with a lower
+          score than the booking.
+
+        A matching without blocking pairs is stable.
+
+        :score:
+            A function returning an array with the score of each booking of
+            the period, like :meth:`ArrayEngine.deferred_acceptance`.
+            Defaults to the priority.
+
+        """
+        scores = self.priority if score is None else score(self)
+
+        accepted = self.state == ACCEPTED
+        candidates = (self.state == OPEN) | (self.state == BLOCKED)
+
+        # the occasions accept bookings scoring higher than their weakest
+        weakest = np.full(self.occasion_count, np.inf)
+        np.minimum.at(weakest, self.occasion[accepted], scores[accepted])
+
+        willing = self.accepted_counts() < self.upper - 1
+        willing = willing[self.occasion] | (weakest[self.occasion] < scores)
+
+        # the attendees prefer bookings listed before all overlapping
+        # accepted bookings, ordered like the wishlists
+        position = np.empty(self.booking_count, np.int64)
+        position[np.lexsort((self.rank, -self.priority, self.attendee))] = \
+            np.arange(self.booking_count)
+
+        i, j = self.attendee_pairs()
+        mask = candidates[i] & accepted[j] & \
+            self.overlaps(self.occasion[i], self.occasion[j])
+
+        first = np.full(self.booking_count, self.booking_count, np.int64)
+        np.minimum.at(first, i[mask], position[j[mask]])
+
+        return np.flatnonzero(candidates & willing & (position < first))
+
+    def assert_correctness(self, only_changes=False):
+        """ Makes sure no attendee has overlapping accepted bookings and no
+        occasion is overbooked.
+
+        With only_changes, only the bookings accepted since loading are
+        checked, together with their attendees and occasions.
+
+        """
+        i, j = self.attendee_pairs()
+        accepted = self.state == ACCEPTED
+
+        clashes = (i != j) & accepted[i] & accepted[j] & \
+            self.overlaps(self.occasion[i], self.occasion[j])
+
+        overbooked = self.accepted_counts() > self.upper - 1
+
+        if only_changes:
+            new = accepted & (self.state != self.initial_state)
+
+            clashes &= new[i] | new[j]
+            overbooked &= np.bincount(
+                self.occasion[new], minlength=self.occasion_count) > 0
+
+        assert not clashes.any(), "Overlapping accepted bookings"
+        assert not overbooked.any(), "Overbooked occasions"
+
+
+class ArrayEngine(object):
+    """ Runs the matching strategies of the experiment on an
+    :class:`ArrayPeriod`, changing its states in place.
+
+    """
+
+    def __init__(self, period, rng=None):
+        self.period = period
+        self.random = rng or random.Random()
+
+        # the number of open overlapping bookings of the same attendee
+        self.impact = None
+
+    def reset(self):
+        self.period.state[:] = OPEN
+
+    def resolve(self, pick_function):
+        """ Returns the pick function of this engine matching the given pick
+        function, which may be given by name or as a pick function of the
+        experiment.
+
+        """
+        if callable(pick_function):
+            pick_function = pick_function.__name__
+
+        return getattr(self, pick_function)
+
+    def impact_counts(self):
+        if self.impact is None:
+            p = self.period
+            i, j = p.attendee_pairs()
+
+            open = p.state == OPEN
+            overlapping = p.overlaps(p.occasion[i], p.occasion[j])
+            mask = open[i] & open[j] & overlapping
+
+            self.impact = np.bincount(i[mask], minlength=p.booking_count)
+
+        return self.impact
+
+    def pick_favorite(self, candidates, count):
+        """ Will simply pick the favorites first in the entered order. """
+        return candidates[::-1][:count]
+
+    def pick_random(self, candidates, count):
+        """ Will pick completely at random. """
+        candidates = candidates.tolist()
+
+        return [
+            candidates.pop(self.random.randint(0, len(candidates) - 1))
+            for _ in range(count)
+        ]
+
+    def pick_random_but_favorites_first(self, candidates, count):
+        """ Picks at random, first only considering favorites, then considering
+        everyone. """
+        favorite = self.period.priority[candidates] != 0
+
+        excited = candidates[favorite].tolist()
+        others = candidates[~favorite].tolist()
+
+        picks = []
+
+        for _ in range(count):
+            if excited:
+                pick = self.random.choice(excited)
+                excited.remove(pick)
+            else:
+                pick = self.random.choice(others)
+                others.remove(pick)
+
+            picks.append(pick)
+
+        return picks
+
+    def pick_least_impact_favorites_first(self, candidates, count):
+        """ Picks the favorites with the least impact amongst all open
+        bookings. That is the booking which will cause the least other
+        bookings to be blocked.
+
+        """
+        impact = self.impact_counts()
+        favorite = self.period.priority[candidates] != 0
+
+        # the impact of the candidates does not change while an occasion is
+        # filled, as the picks only affect the bookings of their attendees
+        order = np.lexsort((
+            np.arange(len(candidates)),
+            impact[candidates],
+            ~favorite
+        ))
+
+        return candidates[order[:count]]
+
+    def accept(self, occasion, picks):
+        """ Accepts the given picks of the given occasion, blocking all open
+        bookings of the same attendees overlapping the occasion.
+
+        """
+        p = self.period
+
+        p.state[picks] = ACCEPTED
+
+        affected = np.concatenate([
+            p.attendee_bookings(a) for a in p.attendee[picks]])
+
+        collateral = affected[
+            (p.state[affected] == OPEN) &
+            p.overlaps(occasion, p.occasion[affected])
+        ]
+
+        p.state[collateral] = BLOCKED
+
+        if self.impact is not None:
+            closed = np.concatenate((picks, collateral))
+            remaining = affected[p.state[affected] == OPEN]
+
+            same = p.attendee[closed][:, None] == p.attendee[remaining]
+            overlapping = p.overlaps(
+                p.occasion[closed][:, None], p.occasion[remaining])
+
+            self.impact[remaining] -= (same & overlapping).sum(axis=0)
+
+    def greedy_matching_until_operable(self, pick_function, safety_margin=0,
+                                       matching_round=0, seed=None,
+                                       shuffled=None):
+        """ Runs one round of greedy matching. The random number generator is
+        seeded with the matching round, unless a seed is given.
+
+        :shuffled:
+            The occasions in the order they are filled, instead of shuffling
+            them (see :mod:`components`).
+
+        """
+
+        p = self.period
+
+        if matching_round == 0:
+            self.reset()
+
+        self.random.seed(matching_round if seed is None else seed)
+
+        pick_function = self.resolve(pick_function)
+        self.impact = None
+
+        # the occasions with open bookings, in the order of their ids
+        by_occasion = np.unique(p.occasion[p.state == OPEN]).tolist()
+
+        if shuffled is None:
+            self.random.shuffle(by_occasion)
+        else:
+            open = set(by_occasion)
+            by_occasion = [o for o in shuffled if o in open]
+
+        accepted = np.bincount(
+            p.occasion[p.state == ACCEPTED], minlength=p.occasion_count)
+
+        for occasion in by_occasion:
+            candidates = p.occasion_bookings(occasion)
+            candidates = candidates[p.state[candidates] == OPEN]
+
+            # if there are not enough bookings for an occasion we must exit
+            if len(candidates) < p.lower[occasion]:
+                continue
+
+            required_picks = p.lower[occasion] + safety_margin
+            available = p.upper[occasion] - 1 - accepted[occasion]
+
+            count = min(len(candidates), required_picks, available)
+
+            if count <= 0:
+                continue
+
+            picks = np.asarray(
+                pick_function(candidates, count), dtype=np.intp)
+
+            self.accept(occasion, picks)
+            accepted[occasion] += len(picks)
+
+    def deferred_acceptance(self, seed=None, score=None, shuffled=None):
+        """ Matches attendees and occasions using deferred acceptance, with a
+        queue of free attendees and a min-heap of accepted bookings per
+        occasion.
+
+        :score:
+            A function returning an array with the score of each booking of
+            the given period. Defaults to the priority.
+
+        :shuffled:
+            The attendees in the order they are queued first, instead of
+            shuffling them (see :mod:`components`).
+
+        """
+        p = self.period
+
+        self.reset()
+
+        if seed is not None:
+            self.random.seed(seed)
+
+        scores = (p.priority if score is None else score(p)).tolist()
+
+        # the wishlists hold positions in the following order, which is
+        # grouped by attendee, then sorted by priority (highest first) and id
+        order = np.lexsort((p.rank, -p.priority, p.attendee))
+        position = np.empty(p.booking_count, np.int64)
+        position[order] = np.arange(p.booking_count)
+
+        position = position.tolist()
+        order = order.tolist()
+        attendee = p.attendee.tolist()
+        occasion = p.occasion.tolist()
+        max_spots = (p.upper - 1).tolist()
+        start = p.start.tolist()
+        end = p.end.tolist()
+
+        def overlaps(a, b):
+            return start[a] <= end[b] and start[b] <= end[a]
+
+        wishlists = [[] for _ in range(p.attendee_count)]
+
+        for ix, booking in enumerate(order):
+            wishlists[attendee[booking]].append(ix)
+
+        accepted = [set() for _ in range(p.attendee_count)]
+        blocked = [set() for _ in range(p.attendee_count)]
+        rejected = [False] * p.booking_count
+
+        # the wishes blocked by each accepted booking and the accepted
+        # bookings blocking each wish
+        blocking = {}
+        blockers = defaultdict(set)
+
+        # min-heap of (score, acceptance, booking) per occasion
+        bookings = [[] for _ in range(p.occasion_count)]
+        acceptance = itertools.count()
+
+        free = deque()
+        queued = [False] * p.attendee_count
+
+        def proposals(a):
+            return (
+                order[ix] for ix in wishlists[a] if not rejected[order[ix]])
+
+        def enqueue(a):
+            if not queued[a] and any(True for b in proposals(a)):
+                free.append(a)
+                queued[a] = True
+
+        def confirm(a, booking):
+            wishlist = wishlists[a]
+
+            collateral = {
+                b for b in chain((order[ix] for ix in wishlist), blocked[a])
+                if b != booking and overlaps(occasion[booking], occasion[b])
+            }
+
+            blocking[booking] = collateral
+
+            for b in collateral:
+                blockers[b].add(booking)
+
+            blocked[a] |= collateral
+            accepted[a].add(booking)
+
+            wishlists[a] = [
+                ix for ix in wishlist
+                if order[ix] != booking and order[ix] not in collateral
+            ]
+
+        def unconfirm(a, booking):
+            insort(wishlists[a], position[booking])
+            accepted[a].remove(booking)
+
+            # reopen the wishes which were only blocked by this booking
+            for b in blocking.pop(booking):
+                blockers[b].remove(booking)
+
+                if not blockers[b]:
+                    del blockers[b]
+                    blocked[a].remove(b)
+                    insort(wishlists[a], position[b])
+
+            enqueue(a)
+
+        def match(a, booking):
+            o = occasion[booking]
+            entry = (scores[booking], next(acceptance), booking)
+
+            if len(bookings[o]) != max_spots[o]:
+                heappush(bookings[o], entry)
+                confirm(a, booking)
+                return True
+
+            if bookings[o][0][0] < entry[0]:
+                confirm(a, booking)
+                b = heapreplace(bookings[o], entry)[2]
+                unconfirm(attendee[b], b)
+                return True
+
+            return False
+
+        if shuffled is None:
+            candidates = [a for a, w in enumerate(wishlists) if w]
+            self.random.shuffle(candidates)
+        else:
+            candidates = [a for a in shuffled if wishlists[a]]
+
+        for candidate in candidates:
+            enqueue(candidate)
+
+        booked = np.unique(p.occasion).tolist()
+        full = sum(1 for o in booked if max_spots[o] == 0)
+
+        while free and full < len(booked):
+            candidate = free.popleft()
+            queued[candidate] = False
+
+            for booking in proposals(candidate):
+                o = occasion[booking]
+                was_full = len(bookings[o]) == max_spots[o]
+
+                if match(candidate, booking):
+                    full += not was_full and len(bookings[o]) == max_spots[o]
+                    enqueue(candidate)
+                    break
+
+                rejected[booking] = True
+
+        p.state[:] = OPEN
+
+        for a in range(p.attendee_count):
+            p.state[list(accepted[a])] = ACCEPTED
+            p.state[list(blocked[a])] = BLOCKED
+
+    def rematch(self, bookings, score=None):
+        """ Repairs the current matching after the given bookings were added
+        (as open bookings), removed (denied or cancelled) or re-prioritised,
+        instead of matching the whole period again.
+
+        Like in :meth:`deferred_acceptance`, attendees propose their wishes
+        in order and occasions keep the bookings with the highest scores.
+        Only the attendees of the given bookings propose at first. Others
+        follow if they are displaced, or if a spot frees up on an occasion
+        they are waiting for. The cost is therefore proportional to the
+        spread of the change, not to the size of the period.
+
+        Returns the number of proposals made.
+
+        """
+        p = self.period
+
+        scores = (p.priority if score is None else score(p)).tolist()
+        state = p.state
+        occasion = p.occasion
+        attendee = p.attendee
+        capacity = p.upper - 1
+        start = p.start.tolist()
+        end = p.end.tolist()
+
+        def overlaps(a, b):
+            return start[a] <= end[b] and start[b] <= end[a]
+
+        # the accepted bookings of the touched occasions, as min-heap of
+        # (score, id rank, booking)
+        heaps = {}
+
+        def accepted(o):
+            if o not in heaps:
+                heaps[o] = [
+                    (scores[b], p.rank[b], b)
+                    for b in p.occasion_bookings(o).tolist()
+                    if state[b] == ACCEPTED
+                ]
+                heapify(heaps[o])
+
+            return heaps[o]
+
+        free = deque()
+        queued = set()
+
+        # the occasions which may have lost accepted bookings
+        vacant = set()
+
+        def enqueue(a):
+            if a not in queued:
+                free.append(a)
+                queued.add(a)
+
+        def wishlist(a):
+            return sorted(
+                (b for b in p.attendee_bookings(a).tolist()
+                 if state[b] in (OPEN, ACCEPTED, BLOCKED)),
+                key=lambda b: (-scores[b], p.rank[b]))
+
+        def preferred(wishes, b):
+            """ The accepted bookings listed before b, overlapping it. """
+            o = occasion[b]
+
+            for c in wishes[:wishes.index(b)]:
+                if state[c] == ACCEPTED and overlaps(o, occasion[c]):
+                    yield c
+
+        def fill(o):
+            """ Wakes the attendees waiting for the given occasion, with the
+            highest scores first, until it is full again.
+
+            """
+            heap = accepted(o)
+            spots = capacity[o] - len(heap)
+
+            waiting = sorted(
+                (b for b in p.occasion_bookings(o).tolist()
+                 if state[b] in (OPEN, BLOCKED)),
+                key=lambda b: (-scores[b], p.rank[b]))
+
+            for b in waiting:
+                if spots <= 0 and not (heap and heap[0][0] < scores[b]):
+                    break
+
+                if any(True for c in preferred(wishlist(attendee[b]), b)):
+                    continue
+
+                enqueue(attendee[b])
+                spots -= 1
+
+        def release(b):
+            heap = accepted(occasion[b])
+            heap.remove((scores[b], p.rank[b], b))
+            heapify(heap)
+
+            state[b] = OPEN
+            vacant.add(occasion[b])
+
+        for b in bookings:
+            enqueue(attendee[b])
+            vacant.add(occasion[b])
+
+        proposals = 0
+
+        while free or vacant:
+            while vacant and not free:
+                fill(vacant.pop())
+
+            if not free:
+                break
+
+            a = free.popleft()
+            queued.discard(a)
+
+            wishes = wishlist(a)
+
+            for b in wishes:
+                if state[b] == ACCEPTED:
+                    continue
+
+                # accepted bookings listed before this one are kept
+                if any(True for c in preferred(wishes, b)):
+                    continue
+
+                proposals += 1
+
+                o = occasion[b]
+                heap = accepted(o)
+                entry = (scores[b], p.rank[b], b)
+
+                if len(heap) < capacity[o]:
+                    heappush(heap, entry)
+                elif heap and heap[0][0] < entry[0]:
+                    displaced = heapreplace(heap, entry)[2]
+                    state[displaced] = OPEN
+                    enqueue(attendee[displaced])
+                else:
+                    continue
+
+                state[b] = ACCEPTED
+
+                # the accepted bookings listed after this one are released
+                for c in wishes:
+                    if c != b and state[c] == ACCEPTED and \
+                            overlaps(o, occasion[c]):
+                        release(c)
+
+            # wishes overlapping accepted bookings are blocked, the spots
+            # this attendee was woken for may be left to others
+            for b in wishes:
+                if state[b] != ACCEPTED:
+                    state[b] = any(
+                        state[c] == ACCEPTED and
+                        overlaps(occasion[b], occasion[c])
+                        for c in wishes if c != b
+                    ) and BLOCKED or OPEN
+
+                    if len(accepted(occasion[b])) < capacity[occasion[b]]:
+                        vacant.add(occasion[b])
+
+        return proposals
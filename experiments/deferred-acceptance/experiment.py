@@ -1,7 +1,13 @@
+import itertools
+import optimum
+import os
 import random
 import transaction
 
-from itertools import groupby, tee
+from collections import defaultdict, deque
+from heapq import heappush, heapreplace
+from itertools import chain, groupby
+from operator import attrgetter
 from datetime import datetime, timedelta, date
 from onegov.activity import Activity, ActivityCollection
 from onegov.activity import Attendee, AttendeeCollection
@@ -11,28 +17,32 @@ from onegov.activity import PeriodCollection
 from onegov.activity.matching import deferred_acceptance_from_database
 from onegov.core.orm import Base
 from onegov.core.orm.session_manager import SessionManager
+from onegov.core.utils import normalize_for_url
 from onegov.user import UserCollection
-from sedate import overlaps
-from boltons.setutils import IndexedSet
+from sedate import standardize_date
+from candidates import CandidatePool
+from components import solve_components
+from conflicts import ImpactIndex, OccasionConflicts
+from engine import EPOCH, ArrayEngine, ArrayPeriod
+from profiling import Instrumentation, instrumented, read_options
+from records import BookingRecord, CapacityLedger
 from statistics import mean, stdev
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy import Enum, MetaData, Text
+from sqlalchemy import and_, case, cast, distinct, func, select, text
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from sortedcontainers import SortedSet
+from typing import NamedTuple, Tuple
 from uuid import uuid4
+from zope.sqlalchemy import mark_changed
 
 
-def pairwise(iterable):
-    a, b = tee(iterable)
-    next(b, None)
-    return zip(a, b)
+def yes_or_no(chance, rng=random):
+    return rng.randint(0, 11) <= chance * 10
 
 
-def yes_or_no(chance):
-    return random.randint(0, 11) <= chance * 10
-
-
-def weighted_random_choice(choices):
-    limit = random.uniform(0, sum(w for c, w in choices))
+def weighted_random_choice(choices, rng=random):
+    limit = rng.uniform(0, sum(w for c, w in choices))
     running_total = 0
 
     for choice, weight in choices:
@@ -41,38 +51,252 @@ def weighted_random_choice(choices):
         running_total += weight
 
 
-def random_spots():
-    min_spots = random.randint(3, 6)
-    max_spots = random.randint(min_spots, 10)
+def random_spots(rng=random):
+    min_spots = rng.randint(3, 6)
+    max_spots = rng.randint(min_spots, 10)
 
     return min_spots, max_spots
 
 
-def drop_all_existing_experiments(dsn):
-    mgr = SessionManager(dsn=dsn, base=Base)
+# the session managers shared by the experiments, by process and dsn
+session_managers = {}
+
+
+def session_manager(dsn):
+    """ Returns the session manager of the given dsn. Experiments using the
+    same dsn share the manager and with it the engine and its pool.
+
+    Processes do not share connections, so each process has its own
+    session managers.
+
+    """
+    key = (os.getpid(), dsn)
+
+    if key not in session_managers:
+        session_managers[key] = SessionManager(
+            dsn=dsn, base=Base, session_config={'expire_on_commit': False})
+
+    return session_managers[key]
+
+
+def drop_schemas(mgr, schemas):
+    """ Drops the given schemas with a single statement. """
+
+    if not schemas:
+        return
+
+    mgr.engine.execute('DROP SCHEMA {} CASCADE'.format(
+        ', '.join('"{}"'.format(schema) for schema in schemas)))
+
+    mgr.created_schemas.difference_update(schemas)
+
+
+def drop_experiments(experiments):
+    """ Drops the schemas of the given experiments, with one statement per
+    session manager.
 
-    for schema in mgr.list_schemas(limit_to_namespace=Experiment.namespace):
-        mgr.engine.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+    """
+    transaction.abort()
+
+    by_manager = defaultdict(list)
+
+    for experiment in experiments:
+        experiment.fixtures_savepoint = None
+        experiment.instrumentation.close()
+        by_manager[experiment.mgr].append(experiment.schema)
+
+    for mgr, schemas in by_manager.items():
+        drop_schemas(mgr, schemas)
+
+    transaction.commit()
+
+
+def drop_all_existing_experiments(dsn, templates=False):
+    """ Drops all experiments of the given dsn, including the templates if
+    requested.
+
+    """
+    mgr = session_manager(dsn)
+
+    namespaces = [Experiment.namespace]
+
+    if templates:
+        namespaces.append(Experiment.template_namespace)
+
+    drop_schemas(mgr, [
+        schema for namespace in namespaces
+        for schema in mgr.list_schemas(limit_to_namespace=namespace)
+    ])
 
     transaction.commit()
-    mgr.dispose()
+
+
+class Metrics(NamedTuple):
+    """ The metrics of an experiment, see :meth:`Experiment.metrics`. """
+
+    activities: int
+    occasions: int
+    attendees: int
+    bookings: int
+
+    #: the share of occasions with enough accepted bookings
+    operable_courses: float
+
+    #: the share of occasions overlapping with at least one other occasion
+    overlapping_occasions: float
+
+    #: the number of bookings and accepted bookings of each occasion
+    bookings_per_occasion: Tuple[int, ...]
+    accepted_per_occasion: Tuple[int, ...]
+
+
+class Convergence(NamedTuple):
+    """ The result of :meth:`Experiment.greedy_matching_until_converged`. """
+
+    #: the number of rounds run, including the last round without picks
+    rounds: int
+
+    #: the global happiness after each round with picks
+    happiness: Tuple[float, ...]
+
+    #: the number of bookings written
+    updated: int
 
 
 class Experiment(object):
 
     namespace = 'da'
 
-    def __init__(self, dsn, drop_others=True):
-        self.mgr = SessionManager(dsn=dsn, base=Base, session_config={
-            'expire_on_commit': False
-        })
+    # the namespace of the schemas holding fixtures to clone
+    template_namespace = 'da_template'
+
+    # the number of rows fetched at once when streaming
+    batch_size = 10000
+
+    def __init__(self, dsn, drop_others=True, seed=None, template=None,
+                 schema=None):
+        """ Creates a new experiment in its own schema, which is a copy of
+        the given template (see :meth:`create_template`) or empty.
+
+        """
+        self.mgr = session_manager(dsn)
 
         # create a new one schema
-        self.schema = '{}-{}'.format(self.namespace, uuid4().hex[:8])
+        self.schema = schema or '{}-{}'.format(
+            self.namespace, uuid4().hex[:8])
         self.mgr.set_current_schema(self.schema)
 
+        # each experiment uses its own random number generator, so multiple
+        # experiments may run in the same process without affecting each other
+        self.random = random.Random(seed)
+
+        # records the runs, as configured in onegov.yml
+        self.instrumentation = Instrumentation(
+            self.mgr.engine, **read_options())
+
+        # the savepoint holding the changes made on top of the fixtures
+        self.fixtures_savepoint = None
+
+        # values derived from the current fixtures
+        self.occasion_conflicts = None
+        self.occasion_spots = None
+        self.occasion_capacity = None
+
+        # values derived from the current booking states
+        self.happiness_snapshot = None
+        self.metrics_snapshot = None
+        self.stability_snapshot = None
+        self.period_snapshot = None
+
+        if template:
+            self.clone_template(template)
+
+    @classmethod
+    def template_schema(cls, name):
+        return '{}-{}'.format(cls.template_namespace, name)
+
+    @classmethod
+    def create_template(cls, dsn, name, seed=None, generator=None,
+                        **fixtures):
+        """ Creates the template with the given name, unless it exists
+        already. The template holds the given fixtures (see
+        :meth:`create_fixtures`) or the fixtures of the given generator (see
+        :meth:`create_generated_fixtures`).
+
+        Experiments created from the template get a copy of the fixtures::
+
+            Experiment.create_template(DSN, 'small', **fixtures)
+
+            for strategy in strategies:
+                experiment = Experiment(DSN, template='small')
+
+        """
+        schema = cls.template_schema(name)
+        mgr = session_manager(dsn)
+
+        if schema in mgr.list_schemas(
+                limit_to_namespace=cls.template_namespace):
+            return
+
+        template = cls(dsn, seed=seed, schema=schema)
+
+        if generator:
+            template.create_generated_fixtures(generator)
+        else:
+            template.create_fixtures(bulk=True, **fixtures)
+
+        template.instrumentation.close()
+
+    @classmethod
+    def drop_templates(cls, dsn, names):
+        """ Drops the templates with the given names. """
+
+        drop_schemas(session_manager(dsn), [
+            cls.template_schema(name) for name in names])
+
+        transaction.commit()
+
+    def clone_template(self, name):
+        """ Copies the rows of the given template into the schema of this
+        experiment, with one INSERT ... SELECT per table.
+
+        """
+        source = self.template_schema(name)
+        tables = [
+            table for base in self.mgr.bases
+            for table in base.metadata.sorted_tables
+        ]
+
+        # the rows created with the schema are replaced by the template
+        for table in reversed(tables):
+            self.session.execute(table.delete())
+
+        metadata = MetaData()
+
+        for table in tables:
+            template = table.tometadata(metadata, schema=source)
+
+            # each schema has its own enum types
+            columns = [
+                cast(cast(c, Text), c.type) if isinstance(c.type, Enum) else c
+                for c in template.c
+            ]
+
+            self.session.execute(
+                table.insert().from_select(table.c.keys(), select(columns)))
+
+        # the transaction does not see statements run outside the orm
+        mark_changed(self.session)
+
+        self.commit()
+        self.fixtures_changed()
+
     @property
     def session(self):
+        # the session manager may be shared with other experiments
+        if self.mgr.current_schema != self.schema:
+            self.mgr.set_current_schema(self.schema)
+
         return self.mgr.session()
 
     def query(self, *args, **kwargs):
@@ -80,7 +304,14 @@ class Experiment(object):
 
     def drop_other_experiments(self):
 
-        transaction.commit()
+        self.commit()
+
+    def drop(self):
+        """ Drops the schema of this experiment. The connections are kept in
+        the pool of the shared engine.
+
+        """
+        drop_experiments((self, ))
 
     def create_owner(self):
         return UserCollection(self.session).add(
@@ -126,7 +357,7 @@ class Experiment(object):
 
         return OccasionCollection(self.session).add(
             activity, period, start, end, 'Europe/Zurich',
-            spots=random_spots()
+            spots=random_spots(self.random)
         )
 
     def create_attendee(self, owner, name, birth_date):
@@ -138,7 +369,11 @@ class Experiment(object):
             owner, attendee, occasion, priority)
 
     def create_fixtures(self, choices, overlapping_chance, attendee_count,
-                        distribution):
+                        distribution, bulk=False):
+
+        if bulk:
+            return self.bulk_create_fixtures(
+                choices, overlapping_chance, attendee_count, distribution)
 
         period = self.create_period()
         owner = self.create_owner()
@@ -150,7 +385,7 @@ class Experiment(object):
                 result.append(factory(result))
 
                 if ix % 10 == 0:
-                    transaction.commit()
+                    self.commit()
 
             return result
 
@@ -158,7 +393,7 @@ class Experiment(object):
         occasions = in_batches(choices, lambda r: self.create_occasion(
             period,
             owner,
-            yes_or_no(overlapping_chance),
+            yes_or_no(overlapping_chance, self.random),
             r and r[-1]
         ))
 
@@ -173,8 +408,9 @@ class Experiment(object):
         bookings = []
 
         for attendee in attendees:
-            number_of_choices = weighted_random_choice(distribution)
-            chosen = random.sample(occasions, number_of_choices)
+            number_of_choices = weighted_random_choice(
+                distribution, self.random)
+            chosen = self.random.sample(occasions, number_of_choices)
 
             for ix, occasion in enumerate(chosen):
                 bookings.append(
@@ -187,32 +423,411 @@ class Experiment(object):
                 )
 
                 if ix % 10 == 0:
-                    transaction.commit()
+                    self.commit()
 
-        transaction.commit()
+        self.commit()
+        self.fixtures_changed()
+
+    def bulk_insert(self, model, rows, batch_size=5000):
+        """ Inserts the given rows (dictionaries) using multi-row inserts.
+
+        This bypasses the ORM, so aggregates and observers are not run. The
+        caller has to provide those values itself.
+
+        """
+        table = model.__table__
+
+        for offset in range(0, len(rows), batch_size):
+            self.session.execute(
+                table.insert().values(rows[offset:offset + batch_size]))
+
+        # the transaction does not see statements run outside the orm
+        mark_changed(self.session)
+
+    def bulk_create_fixtures(self, choices, overlapping_chance,
+                             attendee_count, distribution):
+        """ Creates the same fixtures as :meth:`create_fixtures`, but builds
+        the rows in memory and writes them with a handful of multi-row inserts.
+
+        The random number generator is consumed in the same order as in
+        :meth:`create_fixtures`, so a seeded run results in the same period.
+
+        """
+
+        timezone = 'Europe/Zurich'
+
+        period = self.create_period()
+        owner = self.create_owner()
+
+        activities = []
+        occasions = []
+        attendees = []
+        bookings = []
+
+        # create the activities and occasions
+        previous = None
+
+        for ix in range(choices):
+            overlap = yes_or_no(overlapping_chance, self.random)
+
+            if previous:
+                if overlap:
+                    start = previous['end'] - timedelta(seconds=1)
+                else:
+                    start = previous['end'] + timedelta(seconds=1)
+            else:
+                start = datetime.now()
+
+            start = standardize_date(start, timezone)
+            end = start + timedelta(seconds=60)
+
+            activities.append(self.activity_row(owner))
+
+            previous = {
+                'id': uuid4(),
+                'activity_id': activities[-1]['id'],
+                'period_id': period.id,
+                'active': period.active,
+                'start': start,
+                'end': end,
+                'timezone': timezone,
+                'spots': OccasionCollection.to_half_open_interval(
+                    *random_spots(self.random)),
+                'cost': 0
+            }
+
+            occasions.append(previous)
+
+        # create the attendees
+        for ix in range(attendee_count):
+            attendees.append({
+                'id': uuid4(),
+                'username': owner.username,
+                'name': uuid4().hex,
+                'birth_date': date(2000, 1, 1)
+            })
+
+        # create the bookings
+        for attendee in attendees:
+            number_of_choices = weighted_random_choice(
+                distribution, self.random)
+            chosen = self.random.sample(occasions, number_of_choices)
+
+            for ix, occasion in enumerate(chosen):
+                bookings.append({
+                    'id': uuid4(),
+                    'username': owner.username,
+                    'attendee_id': attendee['id'],
+                    'occasion_id': occasion['id'],
+                    'period_id': occasion['period_id'],
+                    'priority': ix < 3 and 1 or 0,
+                    'state': 'open'
+                })
+
+        self.insert_fixtures(activities, occasions, attendees, bookings)
+
+    def create_generated_fixtures(self, generator):
+        """ Creates the fixtures generated by the given
+        :class:`generator.PeriodGenerator`, with one activity per occasion.
+
+        The rows are written like in :meth:`bulk_create_fixtures`.
+
+        """
+        fixtures = generator.generate()
+        p = fixtures.period
+
+        timezone = 'Europe/Zurich'
+
+        period = self.create_period()
+        owner = self.create_owner()
+
+        activities = [self.activity_row(owner) for _ in p.occasion_ids]
+
+        occasions = [
+            {
+                'id': id,
+                'activity_id': activity['id'],
+                'period_id': period.id,
+                'active': period.active,
+                'start': EPOCH + timedelta(microseconds=start),
+                'end': EPOCH + timedelta(microseconds=end),
+                'timezone': timezone,
+                'spots': OccasionCollection.to_half_open_interval(
+                    lower, upper - 1),
+                'cost': 0
+            }
+            for id, activity, start, end, lower, upper in zip(
+                p.occasion_ids,
+                activities,
+                p.start.tolist(),
+                p.end.tolist(),
+                p.lower.tolist(),
+                p.upper.tolist()
+            )
+        ]
+
+        attendees = [
+            {
+                'id': id,
+                'username': owner.username,
+                'name': uuid4().hex,
+                'birth_date': birth_date
+            }
+            for id, birth_date in zip(
+                p.attendee_ids, fixtures.birth_dates.tolist())
+        ]
+
+        bookings = [
+            {
+                'id': id,
+                'username': owner.username,
+                'attendee_id': p.attendee_ids[attendee],
+                'occasion_id': p.occasion_ids[occasion],
+                'period_id': period.id,
+                'priority': priority,
+                'state': 'open'
+            }
+            for id, attendee, occasion, priority in zip(
+                p.booking_ids,
+                p.attendee.tolist(),
+                p.occasion.tolist(),
+                p.priority.tolist()
+            )
+        ]
+
+        self.insert_fixtures(activities, occasions, attendees, bookings)
+
+    def activity_row(self, owner):
+        """ Returns the row of a new, accepted activity. """
+
+        title = uuid4().hex
+        name = normalize_for_url(title)
+
+        return {
+            'id': uuid4(),
+            'name': name,
+            'title': title,
+            'order': name,
+            'username': owner.username,
+            'reporter': owner.username,
+            'state': 'accepted',
+            'meta': {'lead': None},
+            'content': {'text': None}
+        }
+
+    def insert_fixtures(self, activities, occasions, attendees, bookings):
+        """ Inserts the given rows and updates the activity aggregates. """
+
+        self.bulk_insert(Activity, activities)
+        self.bulk_insert(Occasion, occasions)
+        self.bulk_insert(Attendee, attendees)
+        self.bulk_insert(Booking, bookings)
+
+        # the activity aggregates are usually kept up to date by the orm,
+        # we calculate them in one go, using the same expressions
+        aggregates = self.session.query(Occasion)\
+            .with_entities(
+                Occasion.activity_id.label('activity_id'),
+                func.sum(distinct(Occasion.duration)).label('durations'),
+                func.array_agg(distinct(Occasion.age)).label('ages'),
+                func.array_agg(distinct(Occasion.period_id))
+                .label('period_ids'))\
+            .group_by(Occasion.activity_id)\
+            .subquery()
+
+        self.session.execute(
+            Activity.__table__.update()
+            .where(Activity.id == aggregates.c.activity_id)
+            .values(
+                durations=aggregates.c.durations,
+                ages=aggregates.c.ages,
+                period_ids=aggregates.c.period_ids
+            )
+        )
+
+        mark_changed(self.session)
+
+        self.commit()
+        self.fixtures_changed()
+
+    @property
+    def metrics(self):
+        """ The :class:`Metrics` of the current period and booking states.
+
+        """
+        if self.metrics_snapshot is None:
+            self.metrics_snapshot = self.collect_metrics()
+
+        return self.metrics_snapshot
+
+    def collect_metrics(self):
+        """ Collects the :class:`Metrics`, using one query for the counts and
+        one for the bookings of each occasion.
+
+        """
+
+        def count(model):
+            return self.session.query(func.count(model.id)).as_scalar()
+
+        counts = self.session.query(
+            count(Activity),
+            count(Occasion),
+            count(Attendee),
+            count(Booking)
+        ).one()
+
+        accepted = case([(Booking.state == 'accepted', 1)], else_=0)
+
+        occasions = self.session.query(Occasion)\
+            .with_entities(
+                Occasion.id,
+                Occasion.spots,
+                func.count(Booking.id),
+                func.coalesce(func.sum(accepted), 0))\
+            .outerjoin(Booking, Booking.occasion_id == Occasion.id)\
+            .group_by(Occasion.id)\
+            .all()
+
+        conflicts = self.conflicts
+
+        operable = sum(
+            1 for id, spots, total, accepted in occasions
+            if accepted >= spots.lower
+        )
+
+        overlapping = sum(
+            1 for id, spots, total, accepted in occasions
+            if conflicts.conflicting(id)
+        )
+
+        return Metrics(
+            *counts,
+            operable_courses=occasions and operable / len(occasions) or 0,
+            overlapping_occasions=(
+                occasions and overlapping / len(occasions) or 0),
+            bookings_per_occasion=tuple(o[2] for o in occasions),
+            accepted_per_occasion=tuple(o[3] for o in occasions)
+        )
 
     @property
     def activity_count(self):
-        return self.session.query(Activity).count()
+        return self.metrics.activities
 
     @property
     def occasion_count(self):
-        return self.session.query(Occasion).count()
+        return self.metrics.occasions
 
     @property
     def attendee_count(self):
-        return self.session.query(Attendee).count()
+        return self.metrics.attendees
 
     @property
     def booking_count(self):
-        return self.session.query(Booking).count()
+        return self.metrics.bookings
+
+    @property
+    def conflicts(self):
+        """ The overlaps between all occasions of the period. """
+
+        if self.occasion_conflicts is None:
+            q = self.session.query(Occasion)
+            q = q.with_entities(Occasion.id, Occasion.start, Occasion.end)
+
+            self.occasion_conflicts = OccasionConflicts(q)
+
+        return self.occasion_conflicts
+
+    @property
+    def spots(self):
+        """ The spots of each occasion, as half-open interval. """
+
+        if self.occasion_spots is None:
+            q = self.session.query(Occasion)
+            q = q.with_entities(Occasion.id, Occasion.spots)
+
+            self.occasion_spots = dict(q.all())
+
+        return self.occasion_spots
+
+    @property
+    def capacity(self):
+        """ The maximum number of accepted bookings of each occasion. """
+
+        if self.occasion_capacity is None:
+            self.occasion_capacity = {
+                id: spots.upper - 1 for id, spots in self.spots.items()
+            }
+
+        return self.occasion_capacity
+
+    def booking_rows(self, *order_by):
+        """ Yields the bookings as :class:`records.BookingRecord` in the
+        given order.
+
+        The rows are streamed from a server-side cursor and no ORM objects
+        are created, so the memory used is proportional to the records kept
+        by the caller.
+
+        """
+        q = self.session.query(Booking).with_entities(
+            Booking.id,
+            Booking.attendee_id,
+            Booking.occasion_id,
+            Booking.priority,
+            Booking.state
+        )
+
+        for row in q.order_by(*order_by).yield_per(self.batch_size):
+            yield BookingRecord(*row)
+
+    def capacity_ledger(self, accepted=()):
+        """ Returns a new :class:`records.CapacityLedger` for the period,
+        counting the given accepted bookings.
+
+        """
+        return CapacityLedger(self.spots, accepted)
+
+    def fixtures_changed(self):
+        """ Discards all values derived from the current fixtures. Has to
+        be called whenever occasions or bookings are added or removed.
+
+        """
+        self.occasion_conflicts = None
+        self.occasion_spots = None
+        self.occasion_capacity = None
+        self.booking_states_changed()
+
+    def booking_states_changed(self):
+        """ Discards all values derived from the current booking states. Has
+        to be called whenever the states of the bookings are changed.
+
+        """
+        self.happiness_snapshot = None
+        self.metrics_snapshot = None
+        self.stability_snapshot = None
+        self.period_snapshot = None
+
+    def happiness_scores(self):
+        """ Returns the happiness of all attendees with bookings, computed
+        in a single query (see :meth:`happiness`).
+
+        """
+        weight = Booking.priority + 1
+
+        q = self.session.query(Booking).with_entities(
+            func.sum(case([(Booking.state == 'accepted', weight)], else_=0)),
+            func.sum(weight)
+        )
+        q = q.group_by(Booking.attendee_id)
+
+        return [accepted / total for accepted, total in q]
 
     @property
     def global_happiness_scores(self):
-        return [score for score in (
-            self.happiness(a)
-            for a in self.session.query(Attendee).with_entities(Attendee.id)
-        ) if score is not None]
+        if self.happiness_snapshot is None:
+            self.happiness_snapshot = self.happiness_scores()
+
+        return self.happiness_snapshot
 
     @property
     def global_happiness(self):
@@ -222,6 +837,44 @@ class Experiment(object):
     def global_happiness_stdev(self):
         return stdev(self.global_happiness_scores)
 
+    @property
+    def blocking_pairs(self):
+        """ The ids of the bookings which are not accepted, though both their
+        attendee and their occasion would prefer them (see
+        :meth:`ArrayPeriod.blocking_pairs`).
+
+        """
+        if self.stability_snapshot is None:
+            period = self.arrays()
+
+            self.stability_snapshot = tuple(
+                period.booking_ids[ix] for ix in period.blocking_pairs())
+
+        return self.stability_snapshot
+
+    @property
+    def blocking_pair_count(self):
+        return len(self.blocking_pairs)
+
+    def happiness_bound(self, **options):
+        """ Returns the upper bound of the global happiness achievable with
+        the current fixtures (see :func:`optimum.happiness_bound`)::
+
+            bound = experiment.happiness_bound(time_limit=10)
+            experiment.deferred_acceptance()
+
+            print(bound.gap(experiment.global_happiness))
+
+        """
+        return optimum.happiness_bound(self.arrays(), **options)
+
+    def operable_bound(self, **options):
+        """ Returns the upper bound of the operable courses achievable with
+        the current fixtures (see :func:`optimum.operable_bound`).
+
+        """
+        return optimum.operable_bound(self.arrays(), **options)
+
     def happiness(self, attendee):
         bookings = self.session.query(Booking)\
             .with_entities(Booking.state, Booking.priority)\
@@ -266,6 +919,10 @@ class Experiment(object):
             self.operable_courses * 100
         ), horizontalalignment='right')
 
+        plt.figtext(1.4, 0.725, "Blocking pairs: {}".format(
+            self.blocking_pair_count
+        ), horizontalalignment='right')
+
         # force the yticks to be integers
         subplot.yaxis.set_major_locator(MaxNLocator(integer=True))
 
@@ -284,10 +941,7 @@ class Experiment(object):
         plt.ylabel('Number of Bookings')
         plt.xlabel('Course Index')
 
-        scores = [
-            len(o.bookings) for o in
-            self.query(Occasion).options(joinedload(Occasion.bookings))
-        ]
+        scores = self.metrics.bookings_per_occasion
 
         plt.bar(list(range(len(scores))), sorted(scores))
 
@@ -295,177 +949,181 @@ class Experiment(object):
 
     @property
     def operable_courses(self):
-        accepted = self.session.query(Booking)\
-            .with_entities(func.count(Booking.id).label('count'))\
-            .filter(Booking.occasion_id == Occasion.id)\
-            .filter(Booking.state == 'accepted')\
-            .subquery().lateral()
+        return self.metrics.operable_courses
 
-        o = self.session.query(Occasion, accepted.c.count)
+    @property
+    def overlapping_occasions(self):
+        return self.metrics.overlapping_occasions
 
-        bits = []
+    def protect_fixtures(self):
+        """ Keeps the current fixtures in the database and runs all further
+        changes in a savepoint, which :meth:`reset_bookings` rolls back.
 
-        for occasion, count in o:
-            bits.append(count >= occasion.spots.lower and 1 or 0)
+        Resetting the bookings then takes the same time, no matter how many
+        bookings were changed. The changes are no longer committed though,
+        they are only visible to the session of this experiment.
 
-        if not bits:
-            return 0
+        The savepoint is part of the transaction of the current thread, so
+        only one experiment per thread may protect its fixtures. A commit or
+        abort outside of this experiment closes the savepoint. Changes are
+        then committed, until :meth:`reset_bookings` resets them with an
+        update and opens the savepoint again.
 
-        return sum(bits) / len(bits)
+        """
+        self.fixtures_savepoint = None
+        self.commit()
 
-    @property
-    def overlapping_occasions(self):
-        count = 0
+        self.fixtures_savepoint = self.session.begin_nested()
 
-        o = self.session.query(Occasion)
-        o = o.order_by(Occasion.start, Occasion.end)
+    @property
+    def protected(self):
+        """ True if the changes are kept in the fixtures savepoint. """
 
-        for previous, current in pairwise(o):
-            if current is None:
-                continue
+        return self.fixtures_savepoint is not None \
+            and self.fixtures_savepoint.is_active
 
-            if previous.end > current.start:
-                count += 1
+    def commit(self):
+        """ Commits the changes of a strategy, unless the fixtures are
+        protected, in which case the changes are flushed to the savepoint.
 
-        return count / o.count()
+        """
+        if self.protected:
+            self.session.flush()
+        else:
+            transaction.commit()
 
+    @instrumented
     def reset_bookings(self):
-        q = self.session.query(Booking)
-        q = q.filter(Booking.state != 'open')
-        q.update({Booking.state: 'open'}, 'fetch')
+        if self.protected:
+            self.fixtures_savepoint.rollback()
+            self.fixtures_savepoint = self.session.begin_nested()
 
-        transaction.commit()
+            # objects changed outside the orm are not expired by the rollback
+            self.session.expire_all()
+        else:
+            q = self.session.query(Booking)
+            q = q.filter(Booking.state != 'open')
+            q.update({Booking.state: 'open'}, 'fetch')
+
+            # a closed savepoint is opened again
+            if self.fixtures_savepoint is None:
+                self.commit()
+            else:
+                self.protect_fixtures()
+
+        self.booking_states_changed()
+
+    # The pick functions are called with the :class:`CandidatePool` of an
+    # occasion, the open bookings and the :class:`ImpactIndex`. They return
+    # one of the candidates, which is then removed by the matching loop.
 
     def pick_favorite(self, candidates, *args):
         """ Will simply pick the favorites first in the entered order. """
-        return candidates.pop()
+        return candidates[-1]
 
     def pick_random(self, candidates, *args):
         """ Will pick completely at random. """
-        return candidates.pop(random.randint(0, len(candidates) - 1))
+        return candidates[self.random.randint(0, len(candidates) - 1)]
 
     def pick_random_but_favorites_first(self, candidates, *args):
         """ Picks at random, first only considering favorites, then considering
         everyone. """
-        excited = [c for c in candidates if c.priority]
-
-        if excited:
-            pick = random.choice(excited)
-        else:
-            pick = random.choice([c for c in candidates if not c.priority])
-
-        candidates.remove(pick)
-        return pick
+        return self.random.choice(
+            candidates.favorites() or candidates.others())
 
-    def pick_least_impact_favorites_first(self, candidates, open):
+    def pick_least_impact_favorites_first(self, candidates, open,
+                                          impact=None):
         """ Picks the favorite with the least impact amongst all open
         bookings. That is the booking which will cause the least other
         bookings to be blocked.
 
-        """
-
-        # yields the number of bookings affected by the given one
-        def impact(candidate):
-            impacted = 0
-
-            for b in open:
-                if b.attendee_id == candidate.attendee_id:
-                    is_impacted = overlaps(
-                        b.occasion.start, b.occasion.end,
-                        candidate.occasion.start, candidate.occasion.end
-                    )
-                    impacted += is_impacted and 1 or 0
+        The impact is read from the given :class:`ImpactIndex`, which is
+        kept up to date by the matching loop. Without it, the index is
+        built from the given open bookings.
 
-            return impacted
-
-        excited = [c for c in candidates if c.priority]
+        """
 
-        if excited:
-            pick = min(excited, key=impact)
-        else:
-            pick = min([c for c in candidates if not c.priority], key=impact)
+        if impact is None:
+            impact = ImpactIndex(open, self.conflicts)
 
-        candidates.remove(pick)
-        return pick
+        return impact.least(candidates)
 
-    def greedy_matching_until_operable(self, pick_function, safety_margin=0,
-                                       matching_round=0):
-
-        if matching_round == 0:
-            self.reset_bookings()
+    def greedy_round(self, pick_function, safety_margin, bookings, open,
+                     accepted, blocked, ledger):
+        """ Runs one round of greedy matching in memory and returns the
+        number of bookings picked.
 
-        random.seed(matching_round)
+        The bookings are the open bookings at the start of the matching,
+        ordered by occasion, priority and id. The open, accepted and blocked
+        sets, as well as the capacity ledger, are changed in place.
 
-        q = self.session.query(Booking)
-
-        # higher priority bookings land at the end, since we treat the
-        # candidates as a queue -> they end up at the front of the queue
-        q = q.order_by(Booking.occasion_id, Booking.priority)
-        q = q.options(joinedload(Booking.occasion))
-
-        # read as list first, as the order matters for the grouping
-        open = list(q.filter(Booking.state == 'open'))
+        """
+        conflicts = self.conflicts
+        instrumentation = self.instrumentation
 
         by_occasion = [
-            (occasion, IndexedSet(candidates))
-            for occasion, candidates
-            in groupby(open, key=lambda booking: booking.occasion)
+            (occasion_id, CandidatePool(candidates))
+            for occasion_id, candidates in groupby(
+                (b for b in bookings if b in open),
+                key=attrgetter('occasion_id'))
         ]
 
-        random.shuffle(by_occasion)
+        self.random.shuffle(by_occasion)
+
+        # the open bookings by attendee, updated as bookings are picked
+        impact = ImpactIndex(open, conflicts)
 
-        # the order no longer matters
-        open = set(open)
-        accepted = set(q.filter(Booking.state == 'accepted'))
-        blocked = set(q.filter(Booking.state == 'blocked'))
+        picked = 0
 
-        for occasion, candidates in by_occasion:
+        for occasion_id, candidates in by_occasion:
+            occasion = ledger[occasion_id]
 
             # remove the already blocked or accepted (this loop operates
             # on a separate copy of the data)
-            candidates -= blocked
-            candidates -= accepted
+            candidates.discard([
+                b for b in candidates if b in blocked or b in accepted])
 
             # if there are not enough bookings for an occasion we must exit
-            if len(candidates) < occasion.spots.lower:
+            if len(candidates) < occasion.lower:
                 continue
 
             picks = set()
             collateral = set()
 
-            required_picks = occasion.spots.lower + safety_margin
+            required_picks = occasion.lower + safety_margin
 
-            existing_picks = sum(
-                1 for b in occasion.bookings if b.state == 'accepted')
+            existing_picks = occasion.accepted
 
-            if existing_picks >= (occasion.spots.upper - 1):
+            if existing_picks >= occasion.capacity:
                 continue
 
             while candidates and len(picks) < required_picks:
 
-                if len(picks) + existing_picks == occasion.spots.upper - 1:
+                if len(picks) + existing_picks == occasion.capacity:
                     break
 
                 # pick the next best spot
-                pick = pick_function(candidates, open)
-                picks.add(pick)
+                with instrumentation.phase('pick'):
+                    pick = pick_function(candidates, open, impact)
+                    candidates.remove(pick)
+                    picks.add(pick)
 
                 # keep track of all bookings that would be made impossible
                 # if this occasion was able to fill its quota
-                collateral |= set(
-                    b for b in open
-                    if b.attendee_id == pick.attendee_id and
-                    b not in picks and
-                    overlaps(
-                        b.occasion.start, b.occasion.end,
-                        pick.occasion.start, pick.occasion.end
+                with instrumentation.phase('collateral'):
+                    affected = set(
+                        b for b in impact.attendee_bookings(pick.attendee_id)
+                        if b not in picks and
+                        conflicts.overlaps(b.occasion_id, pick.occasion_id)
                     )
-                )
+                    collateral |= affected
 
                 # remove affected bookings from possible candidates
-                candidates -= collateral
+                candidates.discard(affected)
 
             # confirm picks
+            picked += len(picks)
+            ledger.accept(occasion_id, len(picks))
             accepted |= picks
             open -= picks
 
@@ -473,219 +1131,753 @@ class Experiment(object):
             blocked |= collateral
             open -= collateral
 
+            impact.discard(picks)
+            impact.discard(collateral)
+
+        return picked
+
+    @instrumented
+    def greedy_matching_until_operable(self, pick_function, safety_margin=0,
+                                       matching_round=0, seed=None):
+        """ Runs one round of greedy matching. The random number generator is
+        seeded with the matching round, unless a seed is given.
+
+        """
+
+        instrumentation = self.instrumentation
+
+        if matching_round == 0:
+            self.reset_bookings()
+
+        instrumentation.mark('load')
+
+        self.random.seed(matching_round if seed is None else seed)
+
+        # higher priority bookings land at the end, since we treat the
+        # candidates as a queue -> they end up at the front of the queue
+        rows = self.booking_rows(
+            Booking.occasion_id, Booking.priority, Booking.id)
+
+        # read as list first, as the order matters for the grouping
+        bookings = []
+        accepted = set()
+        blocked = set()
+
+        for row in rows:
+            if row.state == 'open':
+                bookings.append(row)
+            elif row.state == 'accepted':
+                accepted.add(row)
+            elif row.state == 'blocked':
+                blocked.add(row)
+
+        open = set(bookings)
+
+        instrumentation.mark('match')
+
+        self.greedy_round(
+            pick_function, safety_margin, bookings, open, accepted, blocked,
+            self.capacity_ledger(accepted))
+
         # write the changes to the database
-        def update_states(bookings, state):
-            ids = set(b.id for b in bookings)
+        instrumentation.mark('write')
 
-            if not ids:
-                return
+        changes = self.booking_changes(
+            ('open', open),
+            ('accepted', accepted),
+            ('blocked', blocked)
+        )
 
-            b = self.session.query(Booking)
-            b = b.filter(Booking.id.in_(ids))
-            b.update({Booking.state: state}, 'fetch')
+        updated = self.write_states(changes)
 
-        update_states(open, 'open')
-        update_states(accepted, 'accepted')
-        update_states(blocked, 'blocked')
+        self.commit()
+        self.booking_states_changed()
 
-        transaction.commit()
+        instrumentation.mark('verify')
+        self.assert_states_written(changes)
+        self.assert_changes_correctness(accepted, changes)
 
-        self.assert_correctness()
+        return updated
+
+    @instrumented
+    def greedy_matching_until_converged(self, pick_function, safety_margin=0,
+                                        max_rounds=10):
+        """ Runs :meth:`greedy_matching_until_operable` round after round,
+        without going through the database in between.
+
+        The rounds stop once a round makes no new picks, or once the given
+        number of rounds is reached. The result is written at the end, the
+        same as calling :meth:`greedy_matching_until_operable` with matching
+        rounds 0 to n.
+
+        Returns a :class:`Convergence` with the happiness after each round.
+
+        """
+        instrumentation = self.instrumentation
+
+        self.reset_bookings()
+
+        instrumentation.mark('load')
+
+        # all bookings are open after the reset
+        bookings = list(self.booking_rows(
+            Booking.occasion_id, Booking.priority, Booking.id))
 
+        open = set(bookings)
+        accepted = set()
+        blocked = set()
+        ledger = self.capacity_ledger()
+
+        # the total weight of each attendee's bookings, see :meth:`happiness`
+        weights = defaultdict(int)
+
+        for booking in bookings:
+            weights[booking.attendee_id] += booking.priority + 1
+
+        def happiness():
+            accepted_weights = defaultdict(int)
+
+            for booking in accepted:
+                accepted_weights[booking.attendee_id] += booking.priority + 1
+
+            return mean(
+                accepted_weights[attendee] / weight
+                for attendee, weight in weights.items()
+            )
+
+        instrumentation.mark('match')
+
+        scores = []
+        rounds = 0
+
+        for matching_round in range(max_rounds):
+            rounds += 1
+            instrumentation.next_round()
+
+            self.random.seed(matching_round)
+
+            picked = self.greedy_round(
+                pick_function, safety_margin, bookings, open, accepted,
+                blocked, ledger)
+
+            instrumentation.count('picks', picked)
+
+            if not picked:
+                break
+
+            scores.append(happiness())
+
+        # write the changes to the database
+        instrumentation.mark('write')
+
+        changes = self.booking_changes(
+            ('open', open),
+            ('accepted', accepted),
+            ('blocked', blocked)
+        )
+
+        updated = self.write_states(changes)
+
+        self.commit()
+        self.booking_states_changed()
+
+        instrumentation.mark('verify')
+        self.assert_states_written(changes)
+        self.assert_changes_correctness(accepted, changes)
+
+        return Convergence(
+            rounds=rounds,
+            happiness=tuple(scores),
+            updated=updated
+        )
+
+    @instrumented
     def builtin_deferred_acceptance(self,
                                     stability_check=False,
                                     validity_check=True):
         self.reset_bookings()
+
+        self.instrumentation.mark('match')
         deferred_acceptance_from_database(
             self.session, PeriodCollection(self.session).query().first().id,
             stability_check=stability_check,
             validity_check=validity_check
         )
-        transaction.commit()
+
+        self.instrumentation.mark('write')
+        self.commit()
+        self.booking_states_changed()
+
+        self.instrumentation.mark('verify')
         self.assert_correctness()
 
-    def deferred_acceptance(self):
+    @instrumented
+    def deferred_acceptance(self, seed=None, score=None):
+        """ Matches attendees and occasions using deferred acceptance.
+
+        Free attendees are kept in a queue and propose their wishes in order
+        of preference. Each occasion keeps its accepted bookings in a heap,
+        ordered by score, so the weakest booking to displace is found in
+        logarithmic time. The loop stops once the queue is empty or all
+        occasions are full.
+
+        :score:
+            A function returning the score of a booking. Occasions prefer
+            bookings with a higher score. Defaults to the priority.
+
+        """
+        instrumentation = self.instrumentation
+
         self.reset_bookings()
 
+        instrumentation.mark('load')
+
+        if seed is not None:
+            self.random.seed(seed)
+
+        conflicts = self.conflicts
+        score = score or (lambda booking: booking.priority)
+
+        # the queue of attendees with wishes they have not proposed yet
+        free = deque()
+        queued = set()
+
+        # the order in which bookings are accepted, to break ties
+        acceptance = itertools.count()
+
+        def enqueue(attendee):
+            if attendee not in queued and attendee.free:
+                free.append(attendee)
+                queued.add(attendee)
+
         class AttendeePreferences(object):
-            def __init__(self, attendee):
-                self.attendee = attendee
+            def __init__(self, attendee_id, bookings):
+                self.attendee_id = attendee_id
                 self.wishlist = SortedSet([
-                    b for b in attendee.bookings
+                    b for b in bookings
                     if b.state == 'open'
-                ], key=lambda b: b.priority * -1)
+                ], key=lambda b: (b.priority * -1, b.id))
                 self.blocked = set()
                 self.accepted = set()
 
+                # the wishes blocked by each accepted booking and the
+                # accepted bookings blocking each wish
+                self.blocking = {}
+                self.blockers = defaultdict(set)
+
+                # wishes on the wishlist which were turned down - once full,
+                # an occasion only ever raises its bar
+                self.rejected = set()
+
             def __hash__(self):
-                return hash(self.attendee)
+                return hash(self.attendee_id)
 
             def __bool__(self):
                 return len(self.wishlist) > 0
 
+            @property
+            def free(self):
+                return any(True for b in self.proposals)
+
+            @property
+            def proposals(self):
+                return (b for b in self.wishlist if b not in self.rejected)
+
             def confirm(self, booking):
-                self.blocked |= set(
-                    b for b in self.wishlist
+                blocked = set(
+                    b for b in chain(self.wishlist, self.blocked)
                     if hash(b) != hash(booking) and
-                    overlaps(
-                        booking.occasion.start, booking.occasion.end,
-                        b.occasion.start, b.occasion.end
-                    )
+                    conflicts.overlaps(booking.occasion_id, b.occasion_id)
                 )
 
+                self.blocking[booking] = blocked
+
+                for b in blocked:
+                    self.blockers[b].add(booking)
+
                 self.wishlist.remove(booking)
+                self.wishlist -= blocked
+                self.blocked |= blocked
                 self.accepted.add(booking)
 
             def unconfirm(self, booking):
                 self.wishlist.add(booking)
                 self.accepted.remove(booking)
 
-                for x in self.blocked:
-                    for y in self.blocked:
-                        if hash(x) == hash(y):
-                            break
-                        if overlaps(x.occasion.start, x.occasion.end,
-                                    y.occasion.start, y.occasion.end):
-                            break
-                    else:
-                        self.wishlist.add(y)
+                # reopen the wishes which were only blocked by this booking
+                for b in self.blocking.pop(booking):
+                    blockers = self.blockers[b]
+                    blockers.remove(booking)
 
-                self.blocked -= self.wishlist
+                    if not blockers:
+                        del self.blockers[b]
+                        self.blocked.remove(b)
+                        self.wishlist.add(b)
 
-            def pop(self):
-                return self.wishlist.pop(0)
+                enqueue(self)
 
         class OccasionPreferences(object):
             def __init__(self, occasion):
                 self.occasion = occasion
-                self.bookings = set(
-                    b for b in occasion.bookings
-                    if b.state == 'accepted'
-                )
-                self.attendees = {}
+
+                # min-heap of (score, acceptance, booking, attendee)
+                self.bookings = []
 
             def __hash__(self):
-                return hash(self.occasion)
+                return hash(self.occasion.id)
 
             @property
             def operable(self):
-                return len(self.bookings) >= self.occasion.spots.lower
+                return self.occasion.operable
 
             @property
             def full(self):
-                return len(self.bookings) == (self.occasion.spots.upper - 1)
-
-            def score(self, booking):
-                return booking.priority
+                return self.occasion.full
 
             def match(self, attendee, booking):
+                entry = (score(booking), next(acceptance), booking, attendee)
+
                 if not self.full:
-                    self.attendees[booking] = attendee
-                    self.bookings.add(booking)
+                    heappush(self.bookings, entry)
+                    self.occasion.accepted += 1
                     attendee.confirm(booking)
                     return True
 
-                for b in self.bookings:
-                    if self.score(b) < self.score(booking):
-                        attendee.confirm(booking)
-                        self.attendees[b].unconfirm(b)
-                        self.bookings.remove(b)
-                        self.bookings.add(booking)
-                        return True
+                if self.bookings[0][0] < entry[0]:
+                    attendee.confirm(booking)
+                    _, _, b, a = heapreplace(self.bookings, entry)
+                    a.unconfirm(b)
+                    instrumentation.count('displacements')
+                    return True
 
                 return False
 
-        q = self.session.query(Attendee)
-        q = q.options(joinedload(Attendee.bookings))
-        unmatched = set(AttendeePreferences(a) for a in q)
+        ledger = self.capacity_ledger()
+        preferences = {}
 
-        q = self.session.query(Booking)
-        q = q.options(joinedload(Booking.occasion))
+        # attendees without bookings have nothing to propose, so they are
+        # only known through their bookings
+        unmatched = []
 
-        all_bookings = q.all()
+        for attendee_id, bookings in groupby(
+                self.booking_rows(Booking.attendee_id),
+                key=attrgetter('attendee_id')):
 
-        preferences = {
-            o: OccasionPreferences(o)
-            for o in set(b.occasion for b in all_bookings)
-        }
-        occasions = {b: preferences[b.occasion] for b in all_bookings}
+            bookings = list(bookings)
 
-        while next((u for u in unmatched if u), None):
+            for booking in bookings:
+                if booking.occasion_id not in preferences:
+                    preferences[booking.occasion_id] = OccasionPreferences(
+                        ledger[booking.occasion_id])
 
-            if all(p.full for p in preferences.values()):
-                break
+            unmatched.append(AttendeePreferences(attendee_id, bookings))
 
-            candidates = [u for u in unmatched if u]
-            random.shuffle(candidates)
+        candidates = [u for u in unmatched if u]
+        self.random.shuffle(candidates)
 
-            matches = 0
+        for candidate in candidates:
+            enqueue(candidate)
 
-            while candidates:
-                candidate = candidates.pop()
+        full = sum(1 for p in preferences.values() if p.full)
 
-                for booking in candidate.wishlist:
-                    if occasions[booking].match(candidate, booking):
-                        matches += 1
-                        break
+        instrumentation.mark('match')
 
-            if not matches:
-                break
+        # a round ends once each attendee queued at its start has proposed
+        remaining = 0
+
+        while free and full < len(preferences):
+            if not remaining:
+                remaining = len(free)
+                instrumentation.next_round()
+
+            remaining -= 1
+
+            candidate = free.popleft()
+            queued.remove(candidate)
+
+            for booking in candidate.proposals:
+                occasion = preferences[booking.occasion_id]
+                was_full = occasion.full
+
+                instrumentation.count('proposals')
+
+                if occasion.match(candidate, booking):
+                    instrumentation.count('matches')
+                    full += not was_full and occasion.full
+                    enqueue(candidate)
+                    break
+
+                candidate.rejected.add(booking)
 
         # write the changes to the database
-        def update_states(bookings, state):
-            ids = set(b.id for b in bookings)
+        instrumentation.mark('write')
 
-            if not ids:
-                return
+        accepted = [b for a in unmatched for b in a.accepted]
 
-            b = self.session.query(Booking)
-            b = b.filter(Booking.id.in_(ids))
-            b.update({Booking.state: state}, 'fetch')
+        changes = self.booking_changes(
+            ('open', (b for a in unmatched for b in a.wishlist)),
+            ('accepted', accepted),
+            ('blocked', (b for a in unmatched for b in a.blocked))
+        )
 
-        open = set(b for a in unmatched for b in a.wishlist)
-        accepted = set(b for a in unmatched for b in a.accepted)
-        blocked = set(b for a in unmatched for b in a.blocked)
+        updated = self.write_states(changes)
 
-        update_states(open, 'open')
-        update_states(accepted, 'accepted')
-        update_states(blocked, 'blocked')
+        self.commit()
+        self.booking_states_changed()
 
-        transaction.commit()
+        instrumentation.mark('verify')
+        self.assert_states_written(changes)
+        self.assert_changes_correctness(accepted, changes)
 
-        self.assert_correctness()
+        return updated
+
+    def load_arrays(self):
+        """ Loads the occasions and bookings into an :class:`ArrayPeriod`.
+
+        """
+        o = self.session.query(Occasion).with_entities(
+            Occasion.id, Occasion.start, Occasion.end, Occasion.spots)
+
+        return ArrayPeriod(
+            occasions=(
+                (id, start, end, spots.lower, spots.upper)
+                for id, start, end, spots in o
+            ),
+            bookings=(
+                (b.id, b.attendee_id, b.occasion_id, b.priority, b.state)
+                for b in self.booking_rows()
+            )
+        )
+
+    def arrays(self):
+        """ Returns the :class:`ArrayPeriod` of the current booking states.
+
+        The period is loaded once and kept until the booking states change
+        (see :meth:`booking_states_changed`). The strategies running on the
+        period keep it up to date with the states they write.
+
+        """
+        if self.period_snapshot is None:
+            self.period_snapshot = self.load_arrays()
+
+        return self.period_snapshot
+
+    def checkout_arrays(self):
+        """ Returns the :class:`ArrayPeriod` of the current booking states,
+        for a strategy to change. It is no longer kept, until the changes
+        are written and the period is returned with :meth:`keep_arrays`.
+
+        """
+        period = self.arrays()
+        self.period_snapshot = None
+
+        return period
+
+    def keep_arrays(self, period):
+        """ Keeps the given period, after its changes were written. """
+
+        period.mark_written()
+        self.period_snapshot = period
+
+    def export_snapshot(self, path):
+        """ Stores the occasions and bookings of the current period as
+        snapshot (see :meth:`engine.ArrayPeriod.save`).
+
+        """
+        self.arrays().save(path)
+
+    def write_states(self, changes):
+        """ Writes the given (booking id, state) changes to the database and
+        returns the number of bookings which were updated.
+
+        All changes are sent in a single statement, as two arrays which are
+        joined against the bookings table. Bookings which already have the
+        given state are not touched.
+
+        This bypasses the ORM, so the bookings loaded by the session are
+        updated in place, without marking them as dirty.
+
+        """
+        changes = dict(changes)
+
+        if not changes:
+            return 0
+
+        result = self.session.execute(
+            text("""
+                UPDATE bookings SET state = changes.state
+                FROM unnest(
+                    CAST(:ids AS uuid[]),
+                    CAST(:states AS booking_state[])
+                ) AS changes(id, state)
+                WHERE bookings.id = changes.id
+                AND bookings.state != changes.state
+            """),
+            {
+                'ids': [str(id) for id in changes],
+                'states': list(changes.values())
+            }
+        )
+
+        # the transaction does not see statements run outside the orm
+        mark_changed(self.session)
+
+        for obj in self.session.identity_map.values():
+            if isinstance(obj, Booking) and obj.id in changes:
+                set_committed_value(obj, 'state', changes[obj.id])
+
+        return result.rowcount
+
+    def assert_states_written(self, changes):
+        """ Makes sure the given (booking id, state) changes are stored in
+        the database, by reading them back after the commit.
+
+        """
+        changes = dict(changes)
+
+        if not changes:
+            return
+
+        stored = self.session.execute(
+            text("""
+                SELECT count(*) FROM bookings
+                JOIN unnest(
+                    CAST(:ids AS uuid[]),
+                    CAST(:states AS booking_state[])
+                ) AS changes(id, state)
+                ON bookings.id = changes.id
+                AND bookings.state = changes.state
+            """),
+            {
+                'ids': [str(id) for id in changes],
+                'states': list(changes.values())
+            }
+        ).scalar()
+
+        assert stored == len(changes), "{} of {} states written".format(
+            stored, len(changes))
+
+    def booking_changes(self, *groups):
+        """ Returns the (booking id, state) changes resulting from the given
+        (state, bookings) groups, for use with :meth:`write_states`.
+
+        """
+        return [
+            (booking.id, state)
+            for state, bookings in groups
+            for booking in bookings
+            if booking.state != state
+        ]
+
+    @instrumented
+    def array_matching(self, strategy, **kwargs):
+        """ Runs the given strategy of the :class:`ArrayEngine` on the
+        current period and writes the resulting states back::
+
+            experiment.array_matching(
+                'greedy_matching_until_operable',
+                pick_function=experiment.pick_favorite
+            )
+
+        """
+        instrumentation = self.instrumentation
+
+        instrumentation.mark('load')
+        period = self.checkout_arrays()
+
+        instrumentation.mark('match')
+        getattr(ArrayEngine(period, self.random), strategy)(**kwargs)
+
+        instrumentation.mark('write')
+        changes = tuple(period.changes())
+        updated = self.write_states(changes)
+
+        self.commit()
+        self.booking_states_changed()
+
+        instrumentation.mark('verify')
+        self.assert_states_written(changes)
+        period.assert_correctness(only_changes=True)
+
+        self.keep_arrays(period)
+
+        return updated
+
+    @instrumented
+    def rematch(self, booking_ids):
+        """ Repairs the current matching after the bookings with the given
+        ids were added, denied, cancelled or re-prioritised, without
+        resetting the other bookings (see :meth:`ArrayEngine.rematch`)::
+
+            experiment.deferred_acceptance()
+
+            # ... change a few bookings ...
+
+            experiment.rematch(changed_ids)
+
+        The period of the last run on arrays is reused if the booking
+        states have not been changed by other strategies since (see
+        :meth:`arrays`). Only the given bookings are read again, so they
+        may be changed or added without calling :meth:`fixtures_changed`.
+        Bookings which no longer exist are treated as cancelled.
+
+        """
+        instrumentation = self.instrumentation
+
+        instrumentation.mark('load')
+        period = self.checkout_arrays()
+
+        booking_ids = set(booking_ids)
+        rows = self.session.query(Booking).with_entities(
+            Booking.id,
+            Booking.attendee_id,
+            Booking.occasion_id,
+            Booking.priority,
+            Booking.state
+        ).filter(Booking.id.in_(booking_ids)).all()
+
+        bookings = period.update(
+            rows, removed=booking_ids - {row.id for row in rows})
+
+        instrumentation.mark('match')
+        proposals = ArrayEngine(period).rematch(bookings)
+
+        instrumentation.count('proposals', proposals)
+
+        instrumentation.mark('write')
+        changes = tuple(period.changes())
+        updated = self.write_states(changes)
+
+        self.commit()
+        self.booking_states_changed()
+
+        instrumentation.mark('verify')
+        self.assert_states_written(changes)
+        period.assert_correctness(only_changes=True)
+
+        self.keep_arrays(period)
+
+        return updated
+
+    @instrumented
+    def component_matching(self, strategy, seed=0, processes=None, **kwargs):
+        """ Runs the given strategy of the :class:`ArrayEngine` on each
+        connected component of the current period, in parallel, and writes
+        the merged states back (see :mod:`components`).
+
+        """
+        instrumentation = self.instrumentation
+
+        instrumentation.mark('load')
+        period = self.checkout_arrays()
+
+        instrumentation.mark('match')
+        components = solve_components(
+            period, strategy, seed=seed, processes=processes, **kwargs)
+
+        instrumentation.count('components', components)
+
+        instrumentation.mark('write')
+        changes = tuple(period.changes())
+        updated = self.write_states(changes)
+
+        self.commit()
+        self.booking_states_changed()
+
+        instrumentation.mark('verify')
+        self.assert_states_written(changes)
+        period.assert_correctness(only_changes=True)
+
+        self.keep_arrays(period)
+
+        return updated
+
+    def violations(self):
+        """ Returns the bookings and occasions violating the invariants of
+        the matching, as two lists:
+
+        * The pairs of accepted bookings (ids) of the same attendee whose
+          occasions overlap.
+        * The occasions (ids) with more accepted bookings than spots,
+          together with the number of accepted bookings.
+
+        Both are found by the database, only the violations are returned.
+
+        """
+        a, b = aliased(Booking), aliased(Booking)
+        oa, ob = aliased(Occasion), aliased(Occasion)
+
+        # overlaps are inclusive, like in :func:`sedate.overlaps`
+        overlapping = self.session.query(a.id, b.id)\
+            .join(b, and_(a.attendee_id == b.attendee_id, a.id < b.id))\
+            .join(oa, a.occasion_id == oa.id)\
+            .join(ob, b.occasion_id == ob.id)\
+            .filter(a.state == 'accepted')\
+            .filter(b.state == 'accepted')\
+            .filter(oa.start <= ob.end)\
+            .filter(ob.start <= oa.end)
+
+        accepted = func.count(Booking.id)
+
+        overbooked = self.session.query(Occasion.id, accepted)\
+            .join(Booking, Booking.occasion_id == Occasion.id)\
+            .filter(Booking.state == 'accepted')\
+            .group_by(Occasion.id)\
+            .having(accepted >= func.upper(Occasion.spots))
+
+        return overlapping.all(), overbooked.all()
 
     def assert_correctness(self):
+        overlapping, overbooked = self.violations()
+
         # make sure no accepted bookings by attendee overlap
-        q = self.query(Booking)
-        q = q.filter(Booking.state == 'accepted')
-        q = q.options(joinedload(Booking.occasion))
-        q = q.order_by(Booking.attendee_id)
-
-        for attendee_id, bookings in groupby(q, key=lambda b: b.attendee_id):
-            bookings = sorted(list(bookings), key=lambda b: b.occasion.start)
-
-            for previous, current in pairwise(bookings):
-                if previous and current:
-                    assert not overlaps(
-                        previous.occasion.start, previous.occasion.end,
-                        current.occasion.start, current.occasion.end
-                    )
+        assert not overlapping, "Overlapping bookings: {}".format(overlapping)
 
         # make sure no course is overbooked
-        q = self.query(Occasion)
-        q = q.options(joinedload(Occasion.bookings))
+        assert not overbooked, "Overbooked occasions: {}".format(overbooked)
 
-        for occasion in q:
-            if not occasion.bookings:
-                continue
+    def assert_changes_correctness(self, accepted, changes):
+        """ Checks the invariants of :meth:`assert_correctness` in memory,
+        for the bookings accepted by the given changes only.
+
+        :accepted:
+            All accepted bookings after the changes.
+
+        :changes:
+            The (booking id, state) changes, see :meth:`booking_changes`.
+
+        """
+        changed = set(id for id, state in changes if state == 'accepted')
+
+        if not changed:
+            return
 
-            # we don't want to confirm spots which do not lead to a filled
-            # out occasion at this point - though we might have to revisit
-            accepted = [
-                b for b in occasion.bookings if b.state == 'accepted']
+        conflicts = self.conflicts
+        capacity = self.capacity
 
-            if accepted:
-                assert len(accepted) < occasion.spots.upper
+        new = [b for b in accepted if b.id in changed]
+        attendees = set(b.attendee_id for b in new)
+        occasions = set(b.occasion_id for b in new)
+
+        by_attendee = defaultdict(list)
+        by_occasion = defaultdict(int)
+
+        for booking in accepted:
+            if booking.attendee_id in attendees:
+                by_attendee[booking.attendee_id].append(booking)
+
+            if booking.occasion_id in occasions:
+                by_occasion[booking.occasion_id] += 1
+
+        # make sure no accepted bookings by attendee overlap
+        for booking in new:
+            for other in by_attendee[booking.attendee_id]:
+                assert other.id == booking.id or not conflicts.overlaps(
+                    booking.occasion_id, other.occasion_id)
+
+        # make sure no course is overbooked
+        for occasion_id, count in by_occasion.items():
+            assert count <= capacity[occasion_id]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,295 @@
+""" Generates synthetic periods with a production-like skew.
+
+Unlike the fixtures of the experiment, where all occasions are equally
+popular and follow each other a minute apart, the generated periods have:
+
+* Occasions whose popularity follows a Zipf-like distribution.
+* Occasions in the time slots of several days, some of them spanning
+  multiple days and some straddling two slots (the overlap density).
+* Wishlists whose lengths follow a given distribution, with the first few
+  wishes marked as favorites.
+* Sibling groups, whose wishlists are likely to be the same.
+
+All arrays are generated by numpy from a seeded generator, without a
+database. The result is an :class:`engine.ArrayPeriod`, which may be stored
+as snapshot or written to the database of an experiment::
+
+    generator = PeriodGenerator(occasions=5000, attendees=50000, seed=0)
+
+    generator.generate().period.save('period')
+    experiment.create_generated_fixtures(generator)
+
+The times are generated in UTC.
+
+"""
+
+import numpy as np
+import uuid
+
+from datetime import date
+from engine import ArrayPeriod, OPEN
+from typing import NamedTuple
+
+
+#: the number of choices per attendee, as observed in the Ferienpass
+DISTRIBUTION = [
+    (1, .152539137),
+    (2, .119702176),
+    (3, .125620466),
+    (4, .1139748),
+    (5, .119320351),
+    (6, .072928599),
+    (7, .06017192),
+    (8, .053264605),
+    (9, .037037037),
+    (10, .035700649)
+]
+
+#: the number of random keys generated at once when sampling the wishlists
+CHUNK_SIZE = 2 ** 22
+
+HOUR = 3600 * 10 ** 6
+DAY = 24 * HOUR
+
+
+class Fixtures(NamedTuple):
+    """ The result of :meth:`PeriodGenerator.generate`. """
+
+    period: ArrayPeriod
+
+    #: the birth date of each attendee (in the order of the period)
+    birth_dates: np.ndarray
+
+    #: the sibling group of each attendee (in the order of the period)
+    families: np.ndarray
+
+
+class PeriodGenerator(object):
+    """ Generates periods with the given number of occasions and attendees.
+
+    :wishlists:
+        The number of choices per attendee, as (choices, chance) tuples.
+
+    :popularity:
+        The exponent of the Zipf-like popularity of the occasions. Zero
+        makes all occasions equally popular.
+
+    :days, slots, slot_hours:
+        The number of days of the period, the number of slots per day and
+        the hours per slot.
+
+    :multi_day, max_days:
+        The chance of an occasion to span multiple days and the maximum
+        number of days it spans.
+
+    :overlap:
+        The chance of an occasion to straddle two slots, overlapping the
+        occasions of both.
+
+    :siblings, agreement:
+        The chance of an attendee to be the sibling of the previous one and
+        the chance of a sibling to have the same wishes as the first one.
+
+    :favorites:
+        The number of wishes with priority.
+
+    """
+
+    def __init__(self, occasions=1000, attendees=10000,
+                 wishlists=DISTRIBUTION, popularity=1.0, days=10, slots=3,
+                 slot_hours=3, multi_day=0.1, max_days=5, overlap=0.2,
+                 siblings=0.3, agreement=0.5, favorites=3,
+                 start=date(2020, 7, 6), seed=0):
+
+        self.occasions = occasions
+        self.attendees = attendees
+        self.wishlists = wishlists
+        self.popularity = popularity
+        self.days = days
+        self.slots = slots
+        self.slot_hours = slot_hours
+        self.multi_day = multi_day
+        self.max_days = max_days
+        self.overlap = overlap
+        self.siblings = siblings
+        self.agreement = agreement
+        self.favorites = favorites
+        self.start = start
+        self.seed = seed
+
+    def generate(self):
+        """ Returns new :class:`Fixtures`, the same for the same seed. """
+
+        rng = np.random.default_rng(self.seed)
+
+        start, end, lower, upper = self.generate_occasions(rng)
+        weights = self.generate_popularity(rng)
+        families = self.generate_families(rng)
+        birth_dates = self.generate_birth_dates(rng, families)
+        attendee, occasion, wish = self.generate_wishes(
+            rng, weights, families)
+
+        period = ArrayPeriod.__new__(ArrayPeriod)
+
+        # the ids are assigned in ascending order, so the indexes of the
+        # generated arrays follow the order of the ids
+        period.occasion_ids = self.generate_ids(rng, self.occasions)
+        period.attendee_ids = self.generate_ids(rng, self.attendees)
+        booking_ids = self.generate_ids(rng, len(attendee))
+
+        period.start = start
+        period.end = end
+        period.lower = lower
+        period.upper = upper
+
+        priority = (wish < self.favorites).astype(np.int32)
+
+        order = np.lexsort((np.arange(len(attendee)), priority, occasion))
+
+        period.booking_ids = [booking_ids[ix] for ix in order.tolist()]
+        period.attendee = attendee[order].astype(np.int32)
+        period.occasion = occasion[order].astype(np.int32)
+        period.priority = priority[order]
+        period.state = np.full(len(order), OPEN, np.int8)
+
+        period.build()
+
+        return Fixtures(period, birth_dates, families)
+
+    def generate_ids(self, rng, count):
+        """ Returns the given number of sorted uuids. """
+
+        data = rng.bytes(16 * count)
+
+        return sorted(
+            uuid.UUID(bytes=data[ix:ix + 16], version=4)
+            for ix in range(0, len(data), 16)
+        )
+
+    def generate_occasions(self, rng):
+        """ Returns the start, end, lower and upper arrays of the occasions.
+        The spots are returned as half-open interval.
+
+        """
+        count = self.occasions
+
+        length = np.where(
+            rng.random(count) < self.multi_day,
+            rng.integers(2, max(2, self.max_days) + 1, count),
+            1
+        )
+        length = np.minimum(length, self.days)
+
+        day = rng.integers(0, self.days - length + 1)
+        slot = rng.integers(0, self.slots, count)
+        straddling = rng.random(count) < self.overlap
+
+        slot_length = self.slot_hours * HOUR
+
+        # the slots of a day begin at 8:00 and follow each other directly,
+        # the inclusive bounds end a second before the next slot
+        start = np.datetime64(self.start, 'us').astype(np.int64)
+        start = start + day * DAY + 8 * HOUR + slot * slot_length
+        start = start + straddling * (slot_length // 2)
+        end = start + (length - 1) * DAY + slot_length - 10 ** 6
+
+        # the spots are chosen like :func:`experiment.random_spots`
+        lower = rng.integers(3, 7, count)
+        upper = rng.integers(lower, 11) + 1
+
+        return (
+            start.astype(np.int64),
+            end.astype(np.int64),
+            lower.astype(np.int32),
+            upper.astype(np.int32)
+        )
+
+    def generate_popularity(self, rng):
+        """ Returns the Zipf-like weight of each occasion (as logarithm). """
+
+        rank = rng.permutation(self.occasions) + 1
+
+        return -self.popularity * np.log(rank)
+
+    def generate_families(self, rng):
+        """ Returns the sibling group of each attendee. Siblings follow each
+        other.
+
+        """
+        first = rng.random(self.attendees) >= self.siblings
+        first[:1] = True
+
+        return np.cumsum(first) - 1
+
+    def generate_birth_dates(self, rng, families):
+        """ Returns the birth dates of the attendees, between 6 and 15 years
+        before the period. Siblings are born one to three years apart.
+
+        """
+        first = np.flatnonzero(np.diff(families, prepend=-1))
+        position = np.arange(self.attendees) - first[families]
+
+        age = rng.integers(6 * 365, 15 * 365, len(first))[families]
+        age = age - position * rng.integers(365, 3 * 365, self.attendees)
+        age = np.maximum(age, 6 * 365)
+
+        return np.datetime64(self.start, 'D') - age.astype('timedelta64[D]')
+
+    def generate_wishes(self, rng, weights, families):
+        """ Returns the bookings as attendee, occasion and position in the
+        wishlist.
+
+        The occasions are sampled without replacement and weighted by
+        popularity, using the Gumbel-max trick: the wishlist consists of the
+        occasions with the largest perturbed weights, in descending order.
+        Siblings in agreement share the perturbation of the first sibling.
+
+        """
+        choices, chances = zip(*self.wishlists)
+        chances = np.array(chances, np.float64)
+
+        lengths = rng.choice(
+            np.minimum(choices, self.occasions),
+            size=self.attendees,
+            p=chances / chances.sum()
+        )
+        longest = int(lengths.max()) if self.attendees else 0
+
+        first = np.flatnonzero(np.diff(families, prepend=-1))
+        same = rng.random(self.attendees) < self.agreement
+        source = np.where(same, first[families], np.arange(self.attendees))
+
+        rows = max(1, CHUNK_SIZE // max(1, self.occasions))
+        wishlists = []
+
+        # the chunks are aligned with the sibling groups
+        lo = 0
+
+        while lo < self.attendees:
+            hi = first[np.searchsorted(first, lo + rows)] \
+                if lo + rows <= first[-1] else self.attendees
+
+            keys = weights + rng.gumbel(size=(hi - lo, self.occasions))
+            keys = keys[source[lo:hi] - lo]
+
+            top = np.argpartition(-keys, longest - 1, axis=1)[:, :longest]
+            top = np.take_along_axis(
+                top,
+                np.argsort(-np.take_along_axis(keys, top, axis=1), axis=1),
+                axis=1
+            )
+
+            wishlists.append(top)
+            lo = hi
+
+        if not wishlists:
+            empty = np.zeros(0, np.int64)
+            return empty, empty, empty
+
+        top = np.concatenate(wishlists)
+        mask = np.arange(longest) < lengths[:, None]
+
+        attendee = np.repeat(np.arange(self.attendees), lengths)
+        wish = np.broadcast_to(np.arange(longest), top.shape)[mask]
+
+        return attendee, top[mask], wish
@@ -0,0 +1,275 @@
+""" Computes upper bounds for the metrics of the matching strategies.
+
+The matching is formulated as a sparse (mixed integer) linear program on an
+:class:`engine.ArrayPeriod`, with one variable per booking:
+
+* The accepted bookings of each occasion must not exceed its spots.
+* The accepted bookings of each attendee must not overlap. As occasions are
+  intervals, it suffices to have one constraint per start of an occasion,
+  covering all bookings of the attendee spanning that moment.
+
+The global happiness (weighted by priority, like
+:meth:`experiment.Experiment.happiness_scores`) or the number of operable
+courses is maximised. Small periods are solved exactly, large ones as linear
+relaxation, both with a time limit. In any case, the resulting bound is at
+least as high as the optimum, so the gap to a strategy is an upper bound
+on what could still be gained::
+
+    bound = happiness_bound(period)
+    ArrayEngine(period).deferred_acceptance()
+
+    print(bound.gap(period.global_happiness))
+
+The solver is HiGHS, as shipped with scipy. The integer program requires
+scipy 1.9 or later. Older versions (down to 1.5, the last one supporting
+Python 3.6) only solve the linear relaxation.
+
+"""
+
+import numpy as np
+
+from engine import BLOCKED, OPEN, ACCEPTED
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+
+#: the number of bookings up to which the integer program is solved
+MAX_INTEGRAL_BOOKINGS = 50000
+
+
+class Bound(NamedTuple):
+    """ The result of :func:`happiness_bound` or :func:`operable_bound`. """
+
+    #: the upper bound of the metric
+    bound: float
+
+    #: the best matching found (integer program only), as booking states
+    value: Optional[float]
+    states: Optional[np.ndarray]
+
+    #: True if the integer program was solved to optimality
+    optimal: bool
+
+    #: True if the linear relaxation was solved
+    relaxed: bool
+
+    #: the time spent in the solver (seconds)
+    duration: float
+
+    def gap(self, value):
+        """ Returns the relative gap between the given value and the bound.
+
+        """
+        return self.bound and (self.bound - value) / self.bound or 0.0
+
+
+def matching_constraints(period):
+    """ Returns the capacity and non-overlap constraints of the period as
+    scipy :class:`LinearConstraint` (with one column per booking).
+
+    """
+    from scipy.optimize import LinearConstraint
+    from scipy.sparse import csr_matrix, vstack
+
+    n = period.booking_count
+
+    capacity = csr_matrix(
+        (np.ones(n), (period.occasion, np.arange(n))),
+        shape=(period.occasion_count, n))
+
+    # each row holds the bookings of an attendee spanning the start of the
+    # occasion of one of the attendee's bookings
+    i, j = period.attendee_pairs()
+    start = period.start[period.occasion[i]]
+    spanning = (period.start[period.occasion[j]] <= start) & \
+        (start <= period.end[period.occasion[j]])
+
+    overlaps = csr_matrix(
+        (np.ones(spanning.sum()), (i[spanning], j[spanning])), shape=(n, n))
+
+    return LinearConstraint(
+        vstack((capacity, overlaps)).tocsr(),
+        -np.inf,
+        np.concatenate((period.upper - 1, np.ones(n)))
+    )
+
+
+def solve(objective, constraints, upper, integral, time_limit):
+    """ Maximises the given objective, with variables between zero and the
+    given upper bounds, and returns the result of scipy.
+
+    Integer programs without a solution within the time limit are solved
+    again as linear relaxation.
+
+    """
+    from scipy.optimize import Bounds
+
+    try:
+        from scipy.optimize import milp
+    except ImportError:
+        return relax(objective, constraints, upper, time_limit), False
+
+    result = milp(
+        -objective,
+        constraints=constraints,
+        integrality=np.full(len(objective), integral and 1 or 0),
+        bounds=Bounds(0, upper),
+        options={'time_limit': time_limit, 'disp': False}
+    )
+
+    if integral and result.x is None:
+        return solve(objective, constraints, upper, False, time_limit)
+
+    # an interrupted linear program does not bound the optimum
+    if not integral and result.status != 0:
+        raise RuntimeError("No bound found: {}".format(result.message))
+
+    return result, integral
+
+
+def relax(objective, constraints, upper, time_limit):
+    """ Maximises the linear relaxation with :func:`scipy.optimize.linprog`,
+    for versions of scipy without :func:`scipy.optimize.milp`.
+
+    """
+    from scipy.optimize import linprog
+    from scipy.sparse import vstack
+
+    result = linprog(
+        -objective,
+        A_ub=vstack([c.A for c in constraints]).tocsr(),
+        b_ub=np.concatenate([
+            np.broadcast_to(c.ub, c.A.shape[0]) for c in constraints]),
+        bounds=np.column_stack((np.zeros(len(upper)), upper)),
+        method='highs',
+        options={'time_limit': time_limit, 'disp': False}
+    )
+
+    if result.status != 0:
+        raise RuntimeError("No bound found: {}".format(result.message))
+
+    return result
+
+
+def bound_of(period, result, integral, value, duration):
+    """ Turns the given scipy result into a :class:`Bound`. """
+
+    if integral:
+        states = np.where(
+            result.x[:period.booking_count] > 0.5, ACCEPTED, OPEN)
+        states = states.astype(np.int8)
+
+        return Bound(
+            # HiGHS reports the bound of the minimisation
+            bound=float(-result.mip_dual_bound),
+            value=value(states),
+            states=states,
+            optimal=result.status == 0,
+            relaxed=False,
+            duration=duration
+        )
+
+    return Bound(
+        bound=float(-result.fun),
+        value=None,
+        states=None,
+        optimal=False,
+        relaxed=True,
+        duration=duration
+    )
+
+
+def relevant(period):
+    """ Returns a mask of the bookings which may be accepted. """
+    return np.isin(period.state, (OPEN, ACCEPTED, BLOCKED))
+
+
+def happiness_bound(period, integral=None, time_limit=60.0):
+    """ Returns the :class:`Bound` of the global happiness of the period.
+
+    :integral:
+        True to solve the integer program, False to solve the linear
+        relaxation. By default, periods with up to
+        :data:`MAX_INTEGRAL_BOOKINGS` are solved as integer program.
+
+    :time_limit:
+        The number of seconds after which the solver stops. The bound of an
+        integer program stopped early is the best bound found by then.
+
+    """
+    if integral is None:
+        integral = period.booking_count <= MAX_INTEGRAL_BOOKINGS
+
+    weight = period.priority + 1.0
+    total = np.bincount(
+        period.attendee, weights=weight, minlength=period.attendee_count)
+
+    objective = weight / total[period.attendee] / period.attendee_count
+
+    def value(states):
+        return float(objective @ (states == ACCEPTED))
+
+    start = perf_counter()
+    result, integral = solve(
+        objective,
+        [matching_constraints(period)],
+        relevant(period).astype(np.float64),
+        integral,
+        time_limit
+    )
+
+    return bound_of(period, result, integral, value, perf_counter() - start)
+
+
+def operable_bound(period, integral=None, time_limit=60.0):
+    """ Returns the :class:`Bound` of the share of operable courses of the
+    period (see :func:`happiness_bound`).
+
+    Each occasion gets an additional variable, which may only be set if the
+    occasion has enough accepted bookings.
+
+    """
+    from scipy.optimize import LinearConstraint
+    from scipy.sparse import csr_matrix, diags, hstack
+
+    if integral is None:
+        integral = period.booking_count <= MAX_INTEGRAL_BOOKINGS
+
+    n, m = period.booking_count, period.occasion_count
+
+    matching = matching_constraints(period)
+    matching = LinearConstraint(
+        hstack((matching.A, csr_matrix((matching.A.shape[0], m)))).tocsr(),
+        matching.lb,
+        matching.ub
+    )
+
+    # lower * operable - accepted <= 0
+    accepted = csr_matrix(
+        (np.ones(n), (period.occasion, np.arange(n))), shape=(m, n))
+    operable = LinearConstraint(
+        hstack((-accepted, diags(period.lower.astype(np.float64)))).tocsr(),
+        -np.inf,
+        0
+    )
+
+    objective = np.concatenate((np.zeros(n), np.full(m, 1.0 / max(m, 1))))
+
+    def value(states):
+        accepted = np.bincount(
+            period.occasion[states == ACCEPTED], minlength=m)
+
+        return float(np.mean(accepted >= period.lower)) if m else 0.0
+
+    upper = np.concatenate((relevant(period), np.ones(m, bool)))
+
+    start = perf_counter()
+    result, integral = solve(
+        objective,
+        [matching, operable],
+        upper.astype(np.float64),
+        integral,
+        time_limit
+    )
+
+    return bound_of(period, result, integral, value, perf_counter() - start)
@@ -0,0 +1,318 @@
+""" Instruments the runs of an experiment.
+
+Each run of a strategy results in a record (a plain dictionary) with the
+time and the SQL statements spent in each phase of the run, the counters
+of the strategy and optionally the peak memory::
+
+    {
+        'run': 'greedy_matching_until_operable',
+        'duration': 1.2,
+        'peak_memory': None,
+        'phases': {
+            'load': {'time': 0.1, 'statements': 3, 'sql': 0.05},
+            ...
+        },
+        'counters': {'proposals': 100, ...},
+        'rounds': [{'proposals': 80, ...}, {'proposals': 20, ...}]
+    }
+
+The `profile`, `trace_memory` and `sql_query_report` options are read from
+the onegov.yml file in the root of the repository, if present. With
+`profile` enabled, a cProfile of each run is written to the profiles folder.
+The peak memory is traced with `trace_memory`, which defaults to `profile`.
+
+"""
+
+import cProfile
+import os
+import tracemalloc
+import yaml
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from sqlalchemy import event
+from time import perf_counter
+from weakref import WeakKeyDictionary, WeakSet
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+#: the configuration of the repository
+CONFIG = os.path.join(ROOT, 'onegov.yml')
+
+#: the folder created by 'make install' for profiles
+PROFILES = os.path.join(ROOT, 'profiles')
+
+#: the instrumentations of each engine, as engines are shared by experiments
+INSTRUMENTATIONS = WeakKeyDictionary()
+
+
+def read_options(path=CONFIG):
+    """ Returns the instrumentation options of the given onegov.yml. """
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as f:
+        config = yaml.safe_load(f) or {}
+
+    configuration = config.get('configuration') or {}
+
+    return {
+        key: configuration[key]
+        for key in ('profile', 'trace_memory', 'sql_query_report')
+        if key in configuration
+    }
+
+
+def attach(engine, instrumentation):
+    """ Forwards the statements of the given engine to the given
+    instrumentation. Each engine is listened to once, instrumentations are
+    only referenced weakly, so they do not outlive their experiments.
+
+    """
+    if engine not in INSTRUMENTATIONS:
+        INSTRUMENTATIONS[engine] = WeakSet()
+
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        event.listen(engine, 'after_cursor_execute', after_execute)
+
+    INSTRUMENTATIONS[engine].add(instrumentation)
+
+
+def detach(engine, instrumentation):
+    INSTRUMENTATIONS.get(engine, set()).discard(instrumentation)
+
+
+def recording(conn):
+    """ Yields the instrumentations of the connection which are recording
+    a run.
+
+    """
+    for instrumentation in tuple(INSTRUMENTATIONS.get(conn.engine, ())):
+        if instrumentation.record is not None:
+            yield instrumentation
+
+
+def before_execute(conn, *args):
+    for instrumentation in recording(conn):
+        instrumentation.before_execute(conn, *args)
+
+
+def after_execute(conn, *args):
+    for instrumentation in recording(conn):
+        instrumentation.after_execute(conn, *args)
+
+
+def instrumented(method):
+    """ Records each call of the decorated experiment method as run. Calls
+    during another run are recorded as a phase of that run.
+
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.instrumentation.run(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Phase(object):
+    """ Times the enclosed block as phase of the current run. """
+
+    __slots__ = ('instrumentation', 'name')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        if self.instrumentation.record is not None:
+            self.instrumentation.enter(self.name)
+
+    def __exit__(self, *args):
+        if self.instrumentation.record is not None:
+            self.instrumentation.leave_marked()
+            self.instrumentation.leave()
+
+
+class Instrumentation(object):
+    """ Records the runs on the given engine.
+
+    :sql_query_report:
+        'all' to print each statement, 'redundant' to print the statements
+        which were run more than once during a run, 'none' to print nothing.
+
+    :profile:
+        True to write a cProfile of each run to the profiles folder.
+
+    :trace_memory:
+        True to trace the peak memory of each run (defaults to the profile
+        option, as tracing slows down the run).
+
+    """
+
+    def __init__(self, engine, sql_query_report='none', profile=False,
+                 trace_memory=None, profiles=PROFILES):
+        self.sql_query_report = sql_query_report
+        self.profile = profile
+        self.trace_memory = profile if trace_memory is None else trace_memory
+        self.profiles = profiles
+
+        #: the records of all runs so far
+        self.records = []
+
+        # the record of the current run and its open phases
+        self.record = None
+        self.stack = []
+        self.statements = Counter()
+        self.statement_start = None
+
+        self.engine = engine
+
+        attach(engine, self)
+
+    def close(self):
+        """ Stops listening to the engine. """
+
+        detach(self.engine, self)
+
+    @property
+    def last_record(self):
+        return self.records and self.records[-1] or None
+
+    def before_execute(self, conn, cursor, statement, *args):
+        self.statement_start = perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, *args):
+        if self.record is None:
+            return
+
+        phase = self.phase_record(self.stack and self.stack[-1][0] or 'other')
+        phase['statements'] += 1
+        phase['sql'] += perf_counter() - self.statement_start
+
+        if self.sql_query_report == 'all':
+            print(statement)
+        elif self.sql_query_report == 'redundant':
+            self.statements[(statement, repr(parameters))] += 1
+
+    def phase_record(self, name):
+        return self.record['phases'][name]
+
+    def enter(self, name, marked=False):
+        self.stack.append((name, perf_counter(), marked))
+
+    def leave(self):
+        name, start, marked = self.stack.pop()
+        self.phase_record(name)['time'] += perf_counter() - start
+
+    def leave_marked(self):
+        """ Leaves the phases started by :meth:`mark` on top of the stack. """
+
+        while self.stack and self.stack[-1][2]:
+            self.leave()
+
+    def phase(self, name):
+        """ Returns a context manager timing the given phase. """
+        return Phase(self, name)
+
+    def mark(self, name):
+        """ Ends the phase started by the last mark (if any) and starts the
+        given one. Phases entered otherwise are not ended, so a run may mark
+        its phases while it is a phase of another run.
+
+        """
+        if self.record is None:
+            return
+
+        self.leave_marked()
+        self.enter(name, marked=True)
+
+    def count(self, name, amount=1):
+        """ Increases the given counter of the current run and round. """
+
+        if self.record is None:
+            return
+
+        self.record['counters'][name] += amount
+
+        if self.record['rounds']:
+            self.record['rounds'][-1][name] += amount
+
+    def next_round(self):
+        """ Starts a new round of counters. """
+
+        if self.record is not None:
+            self.record['rounds'].append(Counter())
+
+    @contextmanager
+    def run(self, name):
+        if self.record is not None:
+            with self.phase(name):
+                yield self.record
+            return
+
+        record = self.record = {
+            'run': name,
+            'started': datetime.utcnow().isoformat(),
+            'duration': None,
+            'peak_memory': None,
+            'phases': defaultdict(
+                lambda: {'time': 0.0, 'statements': 0, 'sql': 0.0}),
+            'counters': Counter(),
+            'rounds': []
+        }
+
+        self.statements.clear()
+
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+
+        if tracing:
+            tracemalloc.start()
+
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = perf_counter()
+
+        try:
+            yield record
+        finally:
+            while self.stack:
+                self.leave()
+
+            record['duration'] = perf_counter() - start
+
+            if self.profile:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path(record))
+
+            if tracing:
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            if self.sql_query_report == 'redundant':
+                self.report_redundant_statements()
+
+            record['phases'] = dict(record['phases'])
+            record['counters'] = dict(record['counters'])
+            record['rounds'] = [dict(r) for r in record['rounds']]
+
+            self.record = None
+            self.records.append(record)
+
+    def profile_path(self, record):
+        os.makedirs(self.profiles, exist_ok=True)
+
+        return os.path.join(self.profiles, '{}-{}.prof'.format(
+            record['run'], datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')))
+
+    def report_redundant_statements(self):
+        for (statement, parameters), count in self.statements.items():
+            if count > 1:
+                print("{}x {} {}".format(count, statement, parameters))
@@ -0,0 +1,75 @@
+class BookingRecord(object):
+    """ A booking as used by the matching strategies.
+
+    Records are created once per booking and compared by identity, so they
+    may be used in sets and as keys without hashing their ids.
+
+    """
+
+    __slots__ = ('id', 'attendee_id', 'occasion_id', 'priority', 'state')
+
+    def __init__(self, id, attendee_id, occasion_id, priority, state):
+        self.id = id
+        self.attendee_id = attendee_id
+        self.occasion_id = occasion_id
+        self.priority = priority
+        self.state = state
+
+    def __repr__(self):
+        return '<BookingRecord {} {}>'.format(self.id, self.state)
+
+
+class OccasionRecord(object):
+    """ The capacity of an occasion, together with its accepted bookings. """
+
+    __slots__ = ('id', 'lower', 'capacity', 'accepted')
+
+    def __init__(self, id, lower, capacity, accepted=0):
+        self.id = id
+
+        #: the minimum number of accepted bookings
+        self.lower = lower
+
+        #: the maximum number of accepted bookings
+        self.capacity = capacity
+
+        #: the current number of accepted bookings
+        self.accepted = accepted
+
+    @property
+    def full(self):
+        return self.accepted >= self.capacity
+
+    @property
+    def operable(self):
+        return self.accepted >= self.lower
+
+    def __repr__(self):
+        return '<OccasionRecord {} {}/{}-{}>'.format(
+            self.id, self.accepted, self.lower, self.capacity)
+
+
+class CapacityLedger(object):
+    """ Keeps track of the accepted bookings of each occasion during a
+    matching run.
+
+    """
+
+    def __init__(self, spots, accepted=()):
+        """ Takes a dictionary of occasion ids and their spots (as half-open
+        interval) and the bookings accepted before the run.
+
+        """
+        self.occasions = {
+            id: OccasionRecord(id, spots.lower, spots.upper - 1)
+            for id, spots in spots.items()
+        }
+
+        for booking in accepted:
+            self.occasions[booking.occasion_id].accepted += 1
+
+    def __getitem__(self, occasion_id):
+        return self.occasions[occasion_id]
+
+    def accept(self, occasion_id, count=1):
+        self.occasions[occasion_id].accepted += count
@@ -0,0 +1,476 @@
+""" Tests the array engine and its helpers without a database:
+
+    py.test experiments/deferred-acceptance
+
+The periods are generated by :class:`generator.PeriodGenerator`. The parity
+with the greedy matching of the experiment additionally requires the
+onegov packages (but no database).
+
+"""
+
+import numpy as np
+import optimum
+import pytest
+import random
+import uuid
+
+from candidates import CandidatePool
+from collections import namedtuple
+from components import solve_components
+from conflicts import OccasionConflicts
+from engine import ArrayEngine, ArrayPeriod, STATES, OPEN, ACCEPTED
+from generator import PeriodGenerator
+from itertools import product
+from records import BookingRecord, CapacityLedger
+
+
+Candidate = namedtuple('Candidate', 'id priority')
+Spots = namedtuple('Spots', 'lower upper')
+
+PICK_FUNCTIONS = (
+    'pick_favorite',
+    'pick_random',
+    'pick_random_but_favorites_first',
+    'pick_least_impact_favorites_first'
+)
+
+
+def generate(seed, occasions=60, attendees=500, **options):
+    return PeriodGenerator(
+        occasions=occasions, attendees=attendees, seed=seed, **options
+    ).generate().period
+
+
+def occasion_rows(period):
+    """ Returns the occasions of the period as accepted by
+    :class:`engine.ArrayPeriod`.
+
+    """
+    return [
+        (period.occasion_ids[o], int(period.start[o]), int(period.end[o]),
+         int(period.lower[o]), int(period.upper[o]))
+        for o in range(period.occasion_count)
+    ]
+
+
+def booking_rows(period):
+    """ Returns the bookings of the period as read from the database. """
+
+    return [
+        (period.booking_ids[b], period.attendee_ids[period.attendee[b]],
+         period.occasion_ids[period.occasion[b]], int(period.priority[b]),
+         STATES[period.state[b]])
+        for b in range(period.booking_count)
+    ]
+
+
+def assert_same_period(period, other):
+    assert list(period.occasion_ids) == list(other.occasion_ids)
+    assert list(period.booking_ids) == list(other.booking_ids)
+    assert list(period.attendee_ids) == list(other.attendee_ids)
+
+    for name in ('start', 'end', 'lower', 'upper', 'attendee', 'occasion',
+                 'priority', 'state', 'rank', 'occasion_ptr',
+                 'attendee_ptr'):
+        assert np.array_equal(getattr(period, name), getattr(other, name))
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_candidate_pool(seed):
+    rng = random.Random(seed)
+
+    candidates = sorted({
+        Candidate(id, rng.choice((0, 0, 1, 2)))
+        for id in range(rng.randint(0, 60))
+    }, key=lambda c: (c.priority, c.id))
+
+    pool = CandidatePool(candidates)
+
+    while candidates:
+        favorites = [c for c in candidates if c.priority]
+        others = [c for c in candidates if not c.priority]
+
+        assert list(pool) == candidates
+        assert len(pool) == len(candidates)
+        assert list(pool.favorites()) == favorites
+        assert list(pool.others()) == others
+
+        ix = rng.randrange(len(candidates))
+        assert pool[ix] == candidates[ix]
+        assert pool[-ix - 1] == candidates[-ix - 1]
+
+        if favorites:
+            ix = rng.randrange(len(favorites))
+            assert pool.favorites()[ix] == favorites[ix]
+
+        if rng.random() < 0.3:
+            discarded = rng.sample(candidates, min(len(candidates), 3))
+            pool.discard(discarded + [Candidate(-1, 0)])
+
+            candidates = [c for c in candidates if c not in discarded]
+        else:
+            removed = candidates.pop(ix)
+            assert removed in pool
+
+            pool.remove(removed)
+            assert removed not in pool
+
+    assert not pool
+    assert len(pool) == 0
+
+    with pytest.raises(IndexError):
+        pool[0]
+
+
+def test_candidate_pool_random_choice():
+    candidates = [Candidate(id, id % 2) for id in range(20)]
+    pool = CandidatePool(sorted(candidates, key=lambda c: (c.priority, c.id)))
+
+    # the pool consumes the generator like a list
+    expected = random.Random(0).choice(list(pool.favorites()))
+    assert random.Random(0).choice(pool.favorites()) == expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_greedy_matching(seed):
+    period = generate(seed)
+
+    for pick_function in PICK_FUNCTIONS:
+        engine = ArrayEngine(period)
+
+        for matching_round in range(3):
+            engine.greedy_matching_until_operable(
+                pick_function, safety_margin=1, matching_round=matching_round)
+
+            period.assert_correctness()
+
+        states = period.state.copy()
+
+        # seeded runs are repeatable
+        for matching_round in range(3):
+            ArrayEngine(period).greedy_matching_until_operable(
+                pick_function, safety_margin=1, matching_round=matching_round)
+
+        assert np.array_equal(period.state, states)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_greedy_matching_parity_with_experiment(seed):
+    pytest.importorskip('onegov.activity')
+
+    from experiment import Experiment
+    from profiling import Instrumentation
+    from sqlalchemy import create_engine
+
+    period = generate(seed)
+
+    # the in-memory rounds of the experiment, without a session
+    experiment = Experiment.__new__(Experiment)
+    experiment.random = random.Random()
+    experiment.instrumentation = Instrumentation(create_engine('sqlite://'))
+    experiment.occasion_conflicts = OccasionConflicts(
+        (id, start, end) for id, start, end, lower, upper
+        in occasion_rows(period))
+    experiment.occasion_spots = {
+        id: Spots(lower, upper) for id, start, end, lower, upper
+        in occasion_rows(period)
+    }
+
+    bookings = [BookingRecord(*row) for row in booking_rows(period)]
+
+    for pick_function in PICK_FUNCTIONS:
+        engine = ArrayEngine(period)
+
+        open, accepted, blocked = set(bookings), set(), set()
+        ledger = CapacityLedger(experiment.spots)
+
+        for matching_round in range(3):
+            experiment.random.seed(matching_round)
+            experiment.greedy_round(
+                getattr(experiment, pick_function), seed % 2, bookings,
+                open, accepted, blocked, ledger)
+
+            engine.greedy_matching_until_operable(
+                pick_function, seed % 2, matching_round=matching_round)
+
+            assert [
+                'accepted' if b in accepted else
+                'blocked' if b in blocked else 'open'
+                for b in bookings
+            ] == [STATES[state] for state in period.state]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_deferred_acceptance(seed):
+    period = generate(seed)
+
+    ArrayEngine(period).deferred_acceptance(seed=seed)
+    period.assert_correctness()
+
+    # the matching is stable
+    assert len(period.blocking_pairs()) == 0
+
+    # seeded runs are repeatable
+    states = period.state.copy()
+    ArrayEngine(period).deferred_acceptance(seed=seed)
+
+    assert np.array_equal(period.state, states)
+
+
+def test_deferred_acceptance_score():
+    period = generate(0)
+
+    def score(period):
+        return -period.priority
+
+    ArrayEngine(period).deferred_acceptance(seed=0, score=score)
+    period.assert_correctness()
+
+    assert len(period.blocking_pairs(score=score)) == 0
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rematch(seed):
+    period = generate(seed)
+    rng = random.Random(seed)
+
+    ArrayEngine(period).deferred_acceptance(seed=seed)
+    period.mark_written()
+
+    rows = {row[0]: list(row) for row in booking_rows(period)}
+    ids = list(rows)
+    changed = []
+
+    for id in rng.sample(ids, 10):
+        rows[id][4] = 'cancelled'
+        changed.append(id)
+
+    for id in rng.sample(ids, 10):
+        rows[id][3] = 1 - rows[id][3]
+        changed.append(id)
+
+    # added bookings, some of them by new attendees
+    for ix in range(10):
+        attendee_id = ix % 3 and rng.choice(period.attendee_ids) \
+            or uuid.UUID(int=rng.getrandbits(128), version=4)
+
+        id = uuid.UUID(int=rng.getrandbits(128), version=4)
+        rows[id] = [
+            id, attendee_id, rng.choice(period.occasion_ids),
+            rng.randint(0, 1), 'open']
+        changed.append(id)
+
+    removed = rng.sample([id for id in ids if id not in changed], 3)
+
+    for id in removed:
+        rows[id][4] = 'cancelled'
+
+    bookings = period.update(
+        [tuple(rows[id]) for id in changed], removed=removed)
+
+    # the updated period is the same as a period loaded from scratch
+    fresh = ArrayPeriod(occasion_rows(period), map(tuple, rows.values()))
+    assert_same_period(period, fresh)
+
+    assert not list(period.changes())
+    assert [period.booking_ids[b] for b in bookings] \
+        == changed + sorted(removed, key=period.booking_ids.index)
+
+    ArrayEngine(period).rematch(bookings)
+    period.assert_correctness()
+
+    # the repaired matching is stable
+    assert len(period.blocking_pairs()) == 0
+
+    # ... and does not depend on the order of the update
+    ArrayEngine(fresh).rematch([
+        fresh.booking_ids.index(id) for id in changed + removed])
+
+    assert np.array_equal(period.state, fresh.state)
+
+
+def test_rematch_unchanged():
+    period = generate(0)
+
+    ArrayEngine(period).deferred_acceptance(seed=0)
+    period.mark_written()
+
+    ArrayEngine(period).rematch([])
+
+    assert not list(period.changes())
+
+
+@pytest.mark.parametrize('name', ('period.npz', 'period'))
+def test_snapshot(tmpdir, name):
+    period = generate(0)
+    ArrayEngine(period).deferred_acceptance(seed=0)
+
+    path = str(tmpdir.join(name))
+    period.save(path)
+
+    loaded = ArrayPeriod.load(path)
+    assert_same_period(loaded, period)
+
+    assert isinstance(loaded.occasion_ids[0], uuid.UUID)
+    assert isinstance(loaded.booking_ids[0], uuid.UUID)
+    assert isinstance(loaded.attendee_ids[0], uuid.UUID)
+
+    # the loaded states are the initial states and may be changed
+    assert not list(loaded.changes())
+
+    ArrayEngine(loaded).greedy_matching_until_operable('pick_favorite')
+    loaded.assert_correctness()
+
+
+def test_snapshot_rows():
+    period = generate(0)
+    ArrayEngine(period).deferred_acceptance(seed=0)
+
+    # the generated period is the same as one read from the database
+    loaded = ArrayPeriod(occasion_rows(period), booking_rows(period))
+    assert_same_period(loaded, period)
+
+
+def test_components():
+    period = generate(0, occasions=200, attendees=100)
+    components = period.components()
+
+    bookings = np.concatenate(components)
+    assert np.array_equal(np.sort(bookings), np.arange(period.booking_count))
+
+    # no two components share an occasion or an attendee
+    occasions = [set(period.occasion[c].tolist()) for c in components]
+    attendees = [set(period.attendee[c].tolist()) for c in components]
+
+    assert sum(len(o) for o in occasions) == len(set().union(*occasions))
+    assert sum(len(a) for a in attendees) == len(set().union(*attendees))
+
+
+def feasible_states(period):
+    """ Yields all correct matchings of the (tiny) period. """
+
+    for states in product((OPEN, ACCEPTED), repeat=period.booking_count):
+        period.state[:] = states
+
+        try:
+            period.assert_correctness()
+        except AssertionError:
+            continue
+
+        yield period.state.copy()
+
+    period.state[:] = OPEN
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_bounds_optimal(seed):
+    # the integer program requires scipy 1.9
+    pytest.importorskip('scipy', minversion='1.9')
+
+    period = generate(
+        seed, occasions=4, attendees=4, days=1, slots=2,
+        wishlists=((2, 1), (3, 1)))
+
+    happiness = operable = 0.0
+
+    for states in feasible_states(period):
+        period.state[:] = states
+
+        happiness = max(happiness, period.global_happiness)
+        operable = max(operable, period.operable_courses)
+
+    period.state[:] = OPEN
+
+    bound = optimum.happiness_bound(period)
+    assert bound.optimal
+    assert bound.bound == pytest.approx(happiness)
+    assert bound.value == pytest.approx(happiness)
+
+    # the best matching found is correct
+    period.state[:] = bound.states
+    period.assert_correctness()
+    period.state[:] = OPEN
+
+    assert optimum.operable_bound(period).bound == pytest.approx(operable)
+    assert optimum.happiness_bound(period, integral=False).bound \
+        >= happiness - 1e-9
+
+
+@pytest.mark.parametrize('integral', (True, False))
+def test_bounds(integral):
+    pytest.importorskip('scipy')
+
+    period = generate(0)
+
+    happiness = optimum.happiness_bound(period, integral=integral)
+    operable = optimum.operable_bound(period, integral=integral)
+
+    ArrayEngine(period).deferred_acceptance(seed=0)
+
+    assert happiness.bound >= period.global_happiness - 1e-9
+    assert operable.bound >= period.operable_courses - 1e-9
+
+    ArrayEngine(period).greedy_matching_until_operable(
+        'pick_least_impact_favorites_first')
+
+    assert happiness.bound >= period.global_happiness - 1e-9
+    assert operable.bound >= period.operable_courses - 1e-9
+
+
+def merged_period(seeds, **options):
+    """ Returns a period consisting of the generated periods of the given
+    seeds, which do not share any attendees or occasions.
+
+    """
+    occasions, bookings = [], []
+
+    for seed in seeds:
+        period = generate(seed, **options)
+
+        occasions.extend(occasion_rows(period))
+        bookings.extend(booking_rows(period))
+
+    return occasions, bookings
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('strategy, options', (
+    ('deferred_acceptance', {}),
+    ('greedy_matching_until_operable', {
+        'pick_function': 'pick_favorite'}),
+    ('greedy_matching_until_operable', {
+        'pick_function': 'pick_least_impact_favorites_first',
+        'safety_margin': 1}),
+))
+def test_components_parity(seed, strategy, options):
+    # with fewer attendees than spots, the occasions never fill up, so
+    # deferred acceptance runs until all attendees are matched
+    occasions, bookings = merged_period(
+        range(seed * 3, seed * 3 + 3), occasions=40, attendees=30)
+
+    period = ArrayPeriod(occasions, bookings)
+    getattr(ArrayEngine(period), strategy)(seed=seed, **options)
+
+    components = ArrayPeriod(occasions, bookings)
+    count = solve_components(
+        components, strategy, seed=seed, processes=1, **options)
+
+    assert count >= 3
+    assert np.array_equal(components.state, period.state)
+
+
+@pytest.mark.parametrize('strategy, options', (
+    ('deferred_acceptance', {}),
+    ('greedy_matching_until_operable', {'pick_function': 'pick_random'}),
+))
+def test_components_processes(strategy, options):
+    occasions, bookings = merged_period(range(3), occasions=40, attendees=60)
+
+    single = ArrayPeriod(occasions, bookings)
+    solve_components(single, strategy, seed=0, processes=1, **options)
+    single.assert_correctness()
+
+    pool = ArrayPeriod(occasions, bookings)
+    solve_components(pool, strategy, seed=0, processes=2, **options)
+
+    assert np.array_equal(single.state, pool.state)